@@ -1,6 +1,7 @@
 import os
 
 from celery import Celery
+from celery.signals import worker_init
 
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
@@ -8,3 +9,10 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
 app = Celery("rippy")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
+
+
+@worker_init.connect
+def start_metrics_exporter(sender, **kwargs):
+    from rippy.metrics import start_worker_exporter
+
+    start_worker_exporter(list(sender.app.amqp.queues.consume_from or ()))
@@ -14,7 +14,27 @@ import os
 
 import environ
 
-env = environ.Env(DEBUG=(bool, False), RIPPY_DOWNLOAD_CONCURRENCY=(int, 2))
+env = environ.Env(
+    DEBUG=(bool, False),
+    RIPPY_DOWNLOAD_CONCURRENCY=(int, 2),
+    RIPPY_DOWNLOAD_CONCURRENCY_MAX=(int, 16),
+    RIPPY_DOWNLOAD_CONNECT_TIMEOUT=(float, 10),
+    RIPPY_DOWNLOAD_READ_TIMEOUT=(float, 30),
+    RIPPY_DOWNLOAD_MIN_THROUGHPUT=(int, 10240),
+    RIPPY_DOWNLOAD_HEDGE_FACTOR=(float, 3),
+    RIPPY_DOWNLOAD_RANGE_SIZE=(int, 4 * 1024 * 1024),
+    RIPPY_HOST_RATE=(float, 0),
+    RIPPY_HOST_BURST=(int, 0),
+    RIPPY_HOST_CONNECTIONS=(int, 0),
+    RIPPY_HOST_LIMITER=(str, "redis"),
+    RIPPY_STREAMING_MUX=(bool, False),
+    RIPPY_STREAM_BUFFER_SEGMENTS=(int, 16),
+    RIPPY_BROWSER_PAGES=(int, 1),
+    RIPPY_SUSPEND_WAITING_JOBS=(bool, False),
+    RIPPY_PROGRESS_UPDATES_PER_SECOND=(float, 4),
+    RIPPY_METRICS_DIR=(str, ""),
+    RIPPY_WORKER_METRICS_PORT=(int, 0),
+)
 environ.Env.read_env(os.environ.get("ENV_PATH"))
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -140,10 +160,68 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Progress events sent per job per second, the final one is always sent
+PROGRESS_UPDATES_PER_SECOND = env("RIPPY_PROGRESS_UPDATES_PER_SECOND")
+
+# Processes share their metrics through files in METRICS_DIR so /api/metrics/
+# covers the workers too, the directory must be emptied before starting.
+# Workers on other hosts can serve their metrics on WORKER_METRICS_PORT,
+# workers for the download and mux queues on the ports after it.
+METRICS_DIR = env("RIPPY_METRICS_DIR")
+if METRICS_DIR:
+    os.environ.setdefault("prometheus_multiproc_dir", METRICS_DIR)
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", METRICS_DIR)
+WORKER_METRICS_PORT = env("RIPPY_WORKER_METRICS_PORT")
+
 CELERY_RESULT_BACKEND = env("CELERY_RESULT_BACKEND")
 CELERY_BROKER_URL = env("CELERY_BROKER_URL")
 
+# Each stage of a job has its own queue so workers can be sized for the
+# resource the stage is bound by, browser, network or disk.
+CELERY_TASK_ROUTES = {
+    "rippy.tasks.handle_job": {"queue": "extract"},
+    "rippy.tasks.download_job": {"queue": "download"},
+    "rippy.tasks.mux_job": {"queue": "mux"},
+}
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Used for the extraction cache, defaults to the celery broker
+REDIS_URL = env("RIPPY_REDIS_URL", default=CELERY_BROKER_URL)
+
 CHROME_REMOTE_URL = env("CHROME_REMOTE_URL")
 PARSE_BROWSER_URL = env("PARSE_BROWSER_URL")
 
+# Pages kept open and ready for the next job in each worker process
+BROWSER_PAGES = env("RIPPY_BROWSER_PAGES")
+
+# Free the worker while a job waits for user-input, requires watch_suspended_jobs
+SUSPEND_WAITING_JOBS = env("RIPPY_SUSPEND_WAITING_JOBS")
+
+# Segment downloads in flight per host, adjusted between the two from
+# throughput, latency and errors.
 DOWNLOAD_CONCURRENCY = env("RIPPY_DOWNLOAD_CONCURRENCY")
+DOWNLOAD_CONCURRENCY_MAX = env("RIPPY_DOWNLOAD_CONCURRENCY_MAX")
+
+# Segment requests are retried when connecting or reading stalls for longer than
+# the timeouts in seconds or they are slower than MIN_THROUGHPUT bytes per second.
+# Segments taking HEDGE_FACTOR times the median are requested twice, 0 disables.
+DOWNLOAD_CONNECT_TIMEOUT = env("RIPPY_DOWNLOAD_CONNECT_TIMEOUT")
+DOWNLOAD_READ_TIMEOUT = env("RIPPY_DOWNLOAD_READ_TIMEOUT")
+DOWNLOAD_MIN_THROUGHPUT = env("RIPPY_DOWNLOAD_MIN_THROUGHPUT")
+DOWNLOAD_HEDGE_FACTOR = env("RIPPY_DOWNLOAD_HEDGE_FACTOR")
+
+# Media files that are not playlists are downloaded as parallel ranges
+# of this many bytes
+DOWNLOAD_RANGE_SIZE = env("RIPPY_DOWNLOAD_RANGE_SIZE")
+
+# Requests per second and open connections per host shared by all workers,
+# 0 is unlimited. HOST_LIMITER is "redis", or "local" to only limit per process.
+HOST_RATE = env("RIPPY_HOST_RATE")
+HOST_BURST = env("RIPPY_HOST_BURST")
+HOST_CONNECTIONS = env("RIPPY_HOST_CONNECTIONS")
+HOST_LIMITER = env("RIPPY_HOST_LIMITER")
+
+# Feed segments to ffmpeg while downloading instead of merging afterwards,
+# at most STREAM_BUFFER_SEGMENTS segments are kept in memory.
+STREAMING_MUX = env("RIPPY_STREAMING_MUX")
+STREAM_BUFFER_SEGMENTS = env("RIPPY_STREAM_BUFFER_SEGMENTS")
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Job
+from .models import Job, Media
 
 
 admin.site.register(Job)
+admin.site.register(Media)
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import socket
+
+import requests
+
+from django.conf import settings
+from pyppeteer import connect, errors
+
+from .metrics import BROWSER_CONNECT
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.121 Safari/537.36"
+
+
+class BrowserUnavailableException(Exception):
+    """Unable to connect to the browser"""
+
+
+def get_chrome_url():
+    schema, _, hostname, path = settings.CHROME_REMOTE_URL.split("/", 3)
+    hostname, port = hostname.split(":")
+    url = "%s//%s:%s/%s" % (schema, socket.gethostbyname(hostname), port, path)
+
+    r = requests.get(url).json()
+    return r["webSocketDebuggerUrl"]
+
+
+class BrowserPool:
+    """
+    A long-lived connection to the browser with a number of pre-warmed pages,
+    connection is re-established when the browser disconnects.
+    """
+
+    health_check_timeout = 5
+    release_timeout = 10
+
+    def __init__(self, size):
+        self.size = size
+        self.browser = None
+        self.pages = []
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        logger.info("Connecting to browser")
+        loop = asyncio.get_event_loop()
+        with BROWSER_CONNECT.time():
+            try:
+                chrome_url = await loop.run_in_executor(None, get_chrome_url)
+            except (OSError, ValueError, KeyError) as e:
+                raise BrowserUnavailableException("Failed to get chrome URL") from e
+
+            self.browser = await connect({"browserWSEndpoint": chrome_url})
+        self.browser.on("disconnected", self.on_disconnected)
+
+    def on_disconnected(self):
+        logger.warning("Browser disconnected, reconnecting on next use")
+        self.browser = None
+        self.pages = []
+
+    async def new_page(self):
+        page = await self.browser.newPage()
+        await page.setUserAgent(USER_AGENT)
+        await page.setViewport({"width": 1024, "height": 768})
+        return page
+
+    async def is_healthy(self, page):
+        if page.isClosed():
+            return False
+
+        try:
+            await asyncio.wait_for(page.evaluate("1"), self.health_check_timeout)
+        except (errors.PyppeteerError, asyncio.TimeoutError):
+            return False
+        return True
+
+    async def close_page(self, page):
+        try:
+            await page.close()
+        except errors.PyppeteerError:
+            pass
+
+    async def acquire(self):
+        """Get a healthy page, connecting to the browser if needed"""
+        async with self.lock:
+            if self.browser is None:
+                await self.connect()
+
+            while self.pages:
+                page = self.pages.pop()
+                if await self.is_healthy(page):
+                    return page
+                logger.info("Discarding unhealthy page")
+                await self.close_page(page)
+
+            try:
+                return await self.new_page()
+            except errors.PyppeteerError:
+                logger.warning("Failed to open page, reconnecting to browser")
+                await self.disconnect()
+                await self.connect()
+                return await self.new_page()
+
+    async def release(self, page):
+        """Reset a page and put it back into the pool"""
+        page.remove_all_listeners()
+        if self.browser is None or page.isClosed():
+            return
+
+        if len(self.pages) >= self.size:
+            await self.close_page(page)
+            return
+
+        try:
+            await asyncio.wait_for(
+                page.setRequestInterception(False), self.release_timeout
+            )
+            await asyncio.wait_for(page.goto("about:blank"), self.release_timeout)
+        except (errors.PyppeteerError, asyncio.TimeoutError):
+            await self.close_page(page)
+        else:
+            self.pages.append(page)
+
+    async def detach(self, page):
+        """Leave a page open in the browser without returning it to the pool"""
+        page.remove_all_listeners()
+        try:
+            await asyncio.wait_for(
+                page.setRequestInterception(False), self.release_timeout
+            )
+        except (errors.PyppeteerError, asyncio.TimeoutError):
+            pass
+        return page.target._targetId
+
+    async def find_page(self, target_id):
+        """Get a page left open with detach, None if it is gone"""
+        if self.browser is None:
+            await self.connect()
+
+        for target in self.browser.targets():
+            if target._targetId == target_id:
+                return await target.page()
+
+    async def disconnect(self):
+        browser, self.browser, self.pages = self.browser, None, []
+        if browser is not None:
+            browser.remove_listener("disconnected", self.on_disconnected)
+            await browser.disconnect()
+
+
+_browser_pool = None
+
+
+def get_browser_pool():
+    """The browser pool of this worker process"""
+    global _browser_pool
+    if _browser_pool is None:
+        _browser_pool = BrowserPool(settings.BROWSER_PAGES)
+    return _browser_pool
@@ -0,0 +1,59 @@
+import hashlib
+import json
+import logging
+
+from redis.exceptions import RedisError
+
+from .store import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionCache:
+    """
+    Extraction results stored in redis by job url, lets retries and resubmitted
+    urls skip the browser while the extracted media url is still valid.
+    When redis is unavailable every lookup is a miss.
+    """
+
+    prefix = "rippy:extraction:"
+
+    def key(self, url):
+        return self.prefix + hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def get(self, url):
+        try:
+            data = get_redis().get(self.key(url))
+            if data is None:
+                logger.debug("Extraction cache miss for %s" % (url,))
+                get_redis().incr(self.prefix + "misses")
+                return None
+
+            logger.debug("Extraction cache hit for %s" % (url,))
+            get_redis().incr(self.prefix + "hits")
+        except RedisError:
+            logger.exception("Extraction cache unavailable, treating as a miss")
+            return None
+        return json.loads(data.decode("utf-8"))
+
+    def set(self, url, result, ttl):
+        try:
+            get_redis().setex(self.key(url), ttl, json.dumps(result))
+        except RedisError:
+            logger.exception("Unable to store extraction result")
+
+    def invalidate(self, url):
+        try:
+            get_redis().delete(self.key(url))
+            get_redis().incr(self.prefix + "invalidations")
+        except RedisError:
+            logger.exception("Unable to invalidate extraction result")
+
+    def stats(self):
+        """Hits, misses and invalidations of all processes, see metrics"""
+        names = ["hits", "misses", "invalidations"]
+        values = get_redis().mget([self.prefix + name for name in names])
+        return {name: int(value or 0) for name, value in zip(names, values)}
+
+
+extraction_cache = ExtractionCache()
@@ -0,0 +1,122 @@
+import hashlib
+import logging
+import os
+
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Job, Media
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = (Job.PENDING, Job.PARSING, Job.DOWNLOADING, Job.WAITING)
+
+
+def get_variant_key(media_url, output_format):
+    """
+    Identifies the file a job produces from the same media by the path of the
+    playlist variant or file it downloads, the query string is left out as it
+    carries tokens that change between extractions.
+    """
+    path = urlsplit(media_url).path
+    return "%s/%s" % (hashlib.sha1(path.encode("utf-8")).hexdigest(), output_format)
+
+
+def link_media(job, owner):
+    """
+    Finish job with the file downloaded by owner, hardlinked into the folder of
+    the job or referenced when it cannot be linked. Returns False if the file is gone.
+    """
+    source_path = os.path.join(settings.MEDIA_ROOT, str(owner.path))
+    if not owner.path or not os.path.isfile(source_path):
+        return False
+
+    target_path = os.path.join(settings.MEDIA_ROOT, str(job.pk))
+    if not os.path.isdir(target_path):
+        os.makedirs(target_path)
+
+    path = os.path.join(str(job.pk), owner.name)
+    try:
+        os.link(source_path, os.path.join(settings.MEDIA_ROOT, path))
+    except FileExistsError:
+        pass
+    except OSError:
+        logger.info("Unable to hardlink %s, referencing it instead" % (source_path,))
+        path = str(owner.path)
+
+    job.duplicate_of = None
+    job.name = owner.name
+    job.path = path
+    job.status = job.SUCCESS
+    job.status_message = "Finished, same media as job %s" % (owner.pk,)
+    job.save()
+    return True
+
+
+def claim_media(job, extractor_name, media_id, variant):
+    """
+    Check if another job has the media. Returns True if job should download it,
+    False if job was finished with a completed download or attached to a running one.
+    """
+    with transaction.atomic():
+        entry, created = Media.objects.select_for_update().get_or_create(
+            extractor=extractor_name,
+            media_id=media_id,
+            variant=variant,
+            defaults={"job": job},
+        )
+        if created:
+            return True
+
+        if entry.job_id == job.pk:
+            # A retried owner rewrites the file, new jobs wait for it meanwhile
+            if entry.complete:
+                entry.complete = False
+                entry.save()
+            return True
+
+        owner = entry.job
+        if entry.complete:
+            if link_media(job, owner):
+                logger.info("Job %s reused media of job %s" % (job.pk, owner.pk))
+                return False
+        elif owner.status in ACTIVE_STATUSES:
+            logger.info("Job %s waits for job %s" % (job.pk, owner.pk))
+            job.duplicate_of = owner
+            job.status = job.DOWNLOADING
+            job.status_message = "Waiting for job %s with the same media" % (owner.pk,)
+            job.save()
+            return False
+
+        entry.job = job
+        entry.complete = False
+        entry.save()
+    return True
+
+
+def release_media(job):
+    """
+    Mark the media of a finished job as complete and finish the jobs waiting
+    for it, if the job did not succeed the waiting jobs are restarted.
+    """
+    with transaction.atomic():
+        entries = Media.objects.select_for_update().filter(job=job)
+        if job.status == job.SUCCESS:
+            entries.filter(complete=False).update(complete=True)
+        else:
+            entries.filter(complete=False).delete()
+
+        duplicates = list(job.duplicates.filter(status=Job.DOWNLOADING))
+
+    for duplicate in duplicates:
+        if job.status == job.SUCCESS and link_media(duplicate, job):
+            continue
+
+        logger.info("Restarting job %s, job %s did not finish" % (duplicate.pk, job.pk))
+        duplicate.duplicate_of = None
+        duplicate.status = duplicate.PENDING
+        duplicate.status_message = "Job %s did not finish, restarting" % (job.pk,)
+        duplicate.scheduled = False
+        duplicate.save()
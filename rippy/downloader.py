@@ -0,0 +1,518 @@
+import asyncio
+import logging
+import os
+import statistics
+
+from collections import deque
+
+import aiohttp
+
+from urllib.parse import urlsplit
+
+from .metrics import (
+    DOWNLOADED_BYTES,
+    SEGMENT_FAILURES,
+    SEGMENT_LATENCY,
+    SEGMENT_RETRIES,
+    SEGMENT_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class FailedToDownloadSegmentException(Exception):
+    """A piece could not be downloaded"""
+
+
+class SegmentStalledException(Exception):
+    """A segment downloaded slower than the throughput floor"""
+
+
+class ReorderBuffer:
+    """
+    Hands out downloaded segments in playlist order while never holding
+    more than `size` segments that are downloading or waiting to be consumed.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.next_index = 0
+        self.items = {}
+        self.error = None
+        self.condition = asyncio.Condition()
+
+    async def reserve(self, index):
+        """Wait until there is room in the buffer for segment index"""
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.error or index < self.next_index + self.size
+            )
+
+    async def put(self, index, data):
+        async with self.condition:
+            self.items[index] = data
+            self.condition.notify_all()
+
+    async def fail(self, error):
+        async with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    async def get(self):
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.error or self.next_index in self.items
+            )
+            if self.error:
+                raise self.error
+            data = self.items.pop(self.next_index)
+            self.next_index += 1
+            self.condition.notify_all()
+            return data
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit for a single host adjusted with additive increase and
+    multiplicative decrease. After every round of `limit` requests the limit
+    is halved if the host returned errors or asked us to slow down, raised by
+    one if throughput kept up without latency blowing up and kept otherwise.
+    """
+
+    throttle_statuses = (429, 503)
+    max_latency_increase = 2.0
+    min_throughput_ratio = 0.9
+
+    def __init__(self, floor, ceiling):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.limit = floor
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.min_latency = None
+        self.last_throughput = None
+        self.reset_round()
+
+    def reset_round(self):
+        self.round_started = asyncio.get_event_loop().time()
+        self.round_requests = 0
+        self.round_bytes = 0
+        self.round_failures = 0
+        self.round_latencies = []
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def discard(self):
+        """Give back a slot of a request that was cancelled without recording it"""
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def release(self, size, elapsed, status=None, failed=False):
+        """Record the outcome of a request, status is set for HTTP errors"""
+        async with self.condition:
+            self.in_flight -= 1
+            self.round_requests += 1
+            if failed:
+                self.round_failures += 1
+            else:
+                self.round_bytes += size
+                self.round_latencies.append(elapsed)
+                if self.min_latency is None or elapsed < self.min_latency:
+                    self.min_latency = elapsed
+
+            if status in self.throttle_statuses or self.round_requests >= self.limit:
+                self.adjust(throttled=status in self.throttle_statuses)
+            self.condition.notify_all()
+
+    def adjust(self, throttled):
+        elapsed = asyncio.get_event_loop().time() - self.round_started
+        throughput = self.round_bytes / elapsed if elapsed else 0
+        previous_limit = self.limit
+
+        if throttled or self.round_failures:
+            self.limit = max(self.floor, self.limit // 2)
+            self.last_throughput = None
+        elif self.round_latencies:
+            latency = statistics.median(self.round_latencies)
+            latency_ok = latency <= self.min_latency * self.max_latency_increase
+            throughput_ok = (
+                self.last_throughput is None
+                or throughput >= self.last_throughput * self.min_throughput_ratio
+            )
+            if latency_ok and throughput_ok:
+                self.limit = min(self.ceiling, self.limit + 1)
+            self.last_throughput = throughput
+
+        if self.limit != previous_limit:
+            logger.debug(
+                "Changed concurrency from %s to %s" % (previous_limit, self.limit)
+            )
+        self.reset_round()
+
+
+class SegmentDownloader:
+    """
+    Downloads HLS segments with asyncio over a shared keep-alive connection pool,
+    connections to a host are reused between segments instead of doing
+    a new TCP and TLS handshake for every single segment.
+
+    A request is abandoned and retried when connecting or reading stalls or
+    it falls below `min_throughput` bytes per second. A segment taking
+    `hedge_factor` times longer than the median segment gets a duplicate
+    request and whichever finishes first is used.
+
+    Counters of the download are kept in `stats`, pass a dict to collect them.
+    """
+
+    chunk_size = 64 * 1024
+    retries = 3
+    keepalive_timeout = 60
+    connect_timeout = 10
+    read_timeout = 30
+    min_throughput = 10 * 1024
+    throughput_grace = 5
+    hedge_factor = 3.0
+    hedge_min_delay = 1.0
+    hedge_min_samples = 5
+    hedge_check_interval = 0.25
+    max_hedged_ratio = 0.25
+
+    def __init__(
+        self,
+        headers,
+        concurrency,
+        progress_callback=None,
+        max_concurrency=None,
+        host_limiter=None,
+        connect_timeout=None,
+        read_timeout=None,
+        min_throughput=None,
+        hedge_factor=None,
+        stats=None,
+    ):
+        self.headers = headers
+        self.host_limiter = host_limiter
+        self.min_concurrency = concurrency
+        self.max_concurrency = max(concurrency, max_concurrency or concurrency)
+        self.progress_callback = progress_callback
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+        if min_throughput is not None:
+            self.min_throughput = min_throughput
+        if hedge_factor is not None:
+            self.hedge_factor = hedge_factor
+        self.limiters = {}
+        self.latencies = deque(maxlen=100)
+        self.hedges_in_flight = 0
+        self.stats = stats if stats is not None else {}
+        for key in ("bytes", "segments", "retries", "hedged", "hedges_won", "stalled"):
+            self.stats.setdefault(key, 0)
+        self.session = None
+
+    @property
+    def concurrency(self):
+        """The current concurrency summed over all hosts"""
+        return sum(limiter.limit for limiter in self.limiters.values())
+
+    def get_limiter(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.limiters:
+            self.limiters[host] = AdaptiveLimiter(
+                self.min_concurrency, self.max_concurrency
+            )
+        return self.limiters[host]
+
+    async def report_progress(self, total, progress):
+        if self.progress_callback:
+            await self.progress_callback(total, progress, concurrency=self.concurrency)
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=self.max_concurrency,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.connect_timeout, sock_read=self.read_timeout
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=self.headers, timeout=timeout
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        self.session = None
+
+    async def _stream(self, url, byterange, timing):
+        """
+        Do a single request, waiting for the host limiter shared between workers.
+        timing["started"] is set when the request is sent, after that wait.
+        """
+        loop = asyncio.get_event_loop()
+        headers = {}
+        if byterange is not None:
+            offset, length = byterange
+            headers["Range"] = "bytes=%s-%s" % (offset, offset + length - 1)
+
+        host = urlsplit(url).netloc
+        if self.host_limiter is not None:
+            token = await self.host_limiter.acquire_async(host)
+
+        try:
+            chunks, size = [], 0
+            start_time = timing["started"] = loop.time()
+            async with self.session.get(url, headers=headers) as r:
+                r.raise_for_status()
+                if byterange is not None and r.status != 206:
+                    logger.warning("Range ignored by server for url %s" % (url,))
+                    return (await r.read())[offset : offset + length]
+                async for chunk in r.content.iter_chunked(self.chunk_size):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    elapsed = loop.time() - start_time
+                    if (
+                        self.min_throughput
+                        and elapsed > self.throughput_grace
+                        and size / elapsed < self.min_throughput
+                    ):
+                        raise SegmentStalledException()
+            return b"".join(chunks)
+        finally:
+            if self.host_limiter is not None:
+                await self.host_limiter.release_async(host, token)
+
+    async def _fetch(self, url, byterange, attempt):
+        """Download url with retries, attempt["started"] is set when it is sent"""
+        loop = asyncio.get_event_loop()
+        limiter = self.get_limiter(url)
+        host = urlsplit(url).netloc
+        for i in range(self.retries):
+            logger.debug("Starting to download %s attempt %s" % (url, i))
+            if i:
+                self.stats["retries"] += 1
+                SEGMENT_RETRIES.labels(host).inc()
+            await limiter.acquire()
+            # Latency starts when the request is sent, not while waiting for the
+            # host limiter, or queueing in this worker would look like a slow host
+            # and be hedged.
+            attempt.pop("started", None)
+
+            def elapsed():
+                return loop.time() - attempt.get("started", loop.time())
+
+            try:
+                data = await self._stream(url, byterange, attempt)
+            except asyncio.CancelledError:
+                await limiter.discard()
+                raise
+            except aiohttp.ClientResponseError as e:
+                logger.warning("Failed to download url %s, status %s" % (url, e.status))
+                await limiter.release(0, elapsed(), status=e.status, failed=True)
+                if e.status in limiter.throttle_statuses:
+                    await asyncio.sleep(i + 1)
+                continue
+            except SegmentStalledException:
+                logger.warning("Download of url %s stalled" % (url,))
+                self.stats["stalled"] += 1
+                await limiter.release(0, elapsed(), failed=True)
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logger.warning("Failed to download url %s" % (url,))
+                await limiter.release(0, elapsed(), failed=True)
+                continue
+            except BaseException:
+                await limiter.release(0, elapsed(), failed=True)
+                raise
+            latency = elapsed()
+            self.latencies.append(latency)
+            SEGMENT_LATENCY.labels(host).observe(latency)
+            SEGMENT_SIZE.labels(host).observe(len(data))
+            DOWNLOADED_BYTES.labels(host).inc(len(data))
+            await limiter.release(len(data), latency)
+            return data
+        SEGMENT_FAILURES.labels(host).inc()
+        raise FailedToDownloadSegmentException()
+
+    def hedge_delay(self):
+        """Seconds a request may run before it is hedged, None to never hedge"""
+        if not self.hedge_factor or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return max(
+            statistics.median(self.latencies) * self.hedge_factor, self.hedge_min_delay
+        )
+
+    def should_hedge(self, attempt):
+        delay = self.hedge_delay()
+        if delay is None or "started" not in attempt:
+            return False
+        if self.hedges_in_flight >= max(1, self.concurrency * self.max_hedged_ratio):
+            return False
+        return asyncio.get_event_loop().time() - attempt["started"] > delay
+
+    def start_hedge(self, url, byterange):
+        self.stats["hedged"] += 1
+        self.hedges_in_flight += 1
+
+        def done(future):
+            self.hedges_in_flight -= 1
+
+        future = asyncio.ensure_future(self._fetch(url, byterange, {}))
+        future.add_done_callback(done)
+        return future
+
+    async def fetch_segment(self, url, byterange=None):
+        """
+        Download a single segment, or the (offset, length) byterange of it, into
+        memory. Hedged with a duplicate request if it is much slower than the
+        median segment.
+        """
+        attempt = {}
+        primary = asyncio.ensure_future(self._fetch(url, byterange, attempt))
+        pending = {primary}
+        hedge = None
+        try:
+            while True:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_check_interval,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for future in done:
+                    error = future.exception()
+                    if error is None:
+                        if future is hedge:
+                            self.stats["hedges_won"] += 1
+                        data = future.result()
+                        self.stats["segments"] += 1
+                        self.stats["bytes"] += len(data)
+                        return data
+
+                if not pending:
+                    raise error
+
+                if hedge is None and self.should_hedge(attempt):
+                    logger.info("Segment %s is slow, sending hedged request" % (url,))
+                    hedge = self.start_hedge(url, byterange)
+                    pending.add(hedge)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def download_file_segment(self, url, target, byterange=None):
+        """Download a single segment to target, returns number of bytes written"""
+        data = await self.fetch_segment(url, byterange)
+        with open(target, "wb") as f:
+            f.write(data)
+        return len(data)
+
+    async def _download_all(self, items, total, download_item, on_complete):
+        if total is None:
+            total = len(items)
+        # Workers take items from a shared iterator as they go so only the
+        # items in flight exist at any time, items can be a generator.
+        items = enumerate(items, 1)
+        state = {"done": 0, "bytes": 0}
+
+        async def worker():
+            for i, item in items:
+                try:
+                    size = await download_item(*item)
+                except FailedToDownloadSegmentException:
+                    raise FailedToDownloadSegmentException(
+                        "Failed while downloading segment %s" % (i,)
+                    )
+                if on_complete:
+                    on_complete(i - 1, size)
+                state["bytes"] += size
+                state["done"] += 1
+                await self.report_progress(total, state["done"])
+
+        workers = [
+            asyncio.ensure_future(worker())
+            for _ in range(min(self.max_concurrency, total))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+
+        return state["bytes"]
+
+    async def download(self, segments, on_complete=None, total=None):
+        """
+        Download an iterable of (url, byterange, target) tuples with at most the
+        current concurrency of the host in flight. Returns total number of bytes
+        downloaded. total is the number of segments, required if segments has
+        no len().
+
+        on_complete is called with the position in segments and the size
+        of every segment as soon as it is downloaded.
+        """
+
+        async def download_item(url, byterange, target):
+            return await self.download_file_segment(url, target, byterange)
+
+        return await self._download_all(segments, total, download_item, on_complete)
+
+    async def download_ranges(self, url, fd, ranges, on_complete=None, total=None):
+        """
+        Download a list of (offset, length) ranges of a single url into the
+        file descriptor fd at their offset, works like download.
+        """
+
+        async def download_item(offset, length):
+            data = await self.fetch_segment(url, (offset, length))
+            if len(data) != length:
+                logger.warning(
+                    "Got %s bytes of %s for range at %s" % (len(data), length, offset)
+                )
+                raise FailedToDownloadSegmentException()
+            os.pwrite(fd, data, offset)
+            return length
+
+        return await self._download_all(ranges, total, download_item, on_complete)
+
+    async def iter_segments(self, segments, buffer_size, total=None):
+        """
+        Download an iterable of (url, byterange) tuples and yield their content
+        in playlist order as soon as possible, at most `buffer_size` segments
+        are kept in memory. total works like in download.
+        """
+        if total is None:
+            total = len(segments)
+        buffer = ReorderBuffer(buffer_size)
+        segments = enumerate(segments)
+
+        async def worker():
+            for i, (url, byterange) in segments:
+                await buffer.reserve(i)
+                try:
+                    data = await self.fetch_segment(url, byterange)
+                except FailedToDownloadSegmentException:
+                    await buffer.fail(
+                        FailedToDownloadSegmentException(
+                            "Failed while downloading segment %s" % (i + 1,)
+                        )
+                    )
+                    return
+                await buffer.put(i, data)
+
+        workers = [
+            asyncio.ensure_future(worker())
+            for _ in range(min(self.max_concurrency, total))
+        ]
+        try:
+            for i in range(1, total + 1):
+                yield await buffer.get()
+                await self.report_progress(total, i)
+        finally:
+            for w in workers:
+                w.cancel()
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .metrics import EVENT_QUEUE_DEPTH, EVENTS
+
+logger = logging.getLogger(__name__)
+
+
+class EventPublisher:
+    """
+    Sends events to the channel layer from one background thread with its own
+    event loop, events for the same job are sent in the order they are published.
+
+    An event superseding the last pending event of the same type and job
+    replaces it, unless it is published with merge=False. Progress updates
+    are throttled per job to at most one every `progress_interval` seconds,
+    the final update is always sent.
+    """
+
+    max_queue_depth = 10000
+
+    def __init__(self, progress_interval):
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.queue_depth = 0
+        self.last_progress_sent = {}
+        self.finished_jobs = set()
+        self.stats = {"published": 0, "merged": 0, "dropped": 0, "sent": 0}
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.wakeup = asyncio.Event()
+        self.started.set()
+        self.loop.run_until_complete(self.send_events())
+
+    def count(self, outcome):
+        self.stats[outcome] += 1
+        EVENTS.labels(outcome).inc()
+
+    def set_queue_depth(self, depth):
+        self.queue_depth = depth
+        EVENT_QUEUE_DEPTH.set(depth)
+
+    def forget(self, job_id):
+        """Drop the progress throttling of a finished job once its events are sent"""
+        with self.lock:
+            if job_id in self.pending:
+                self.finished_jobs.add(job_id)
+            else:
+                self.last_progress_sent.pop(job_id, None)
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def publish(self, job_id, event_type, merge=True, **kwargs):
+        kwargs.update({"type": event_type, "id": job_id})
+        with self.lock:
+            self.count("published")
+            queue = self.pending.setdefault(job_id, deque())
+            if merge and queue and queue[-1]["type"] == event_type:
+                queue[-1] = kwargs
+                self.count("merged")
+            elif (
+                event_type == "job.progress"
+                and self.queue_depth >= self.max_queue_depth
+            ):
+                self.count("dropped")
+                return
+            else:
+                queue.append(kwargs)
+                self.set_queue_depth(self.queue_depth + 1)
+        self.notify()
+
+    def is_final_progress(self, event):
+        return event["progress"] >= event["total"]
+
+    def get_due_events(self):
+        """Pop the events that can be sent now and when the next one is due"""
+        now = time.monotonic()
+        due, next_due = [], None
+        with self.lock:
+            for job_id, queue in list(self.pending.items()):
+                while queue:
+                    event = queue[0]
+                    if event["type"] == "job.progress":
+                        if self.is_final_progress(event):
+                            self.last_progress_sent.pop(job_id, None)
+                        else:
+                            send_at = (
+                                self.last_progress_sent.get(job_id, 0)
+                                + self.progress_interval
+                            )
+                            if send_at > now:
+                                if next_due is None or send_at < next_due:
+                                    next_due = send_at
+                                break
+                            self.last_progress_sent[job_id] = now
+                    due.append(queue.popleft())
+                    self.set_queue_depth(self.queue_depth - 1)
+
+                if not queue:
+                    del self.pending[job_id]
+                    if job_id in self.finished_jobs:
+                        self.finished_jobs.discard(job_id)
+                        self.last_progress_sent.pop(job_id, None)
+        return due, next_due
+
+    async def send_events(self):
+        channel_layer = get_channel_layer()
+        timeout = None
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            due, next_due = self.get_due_events()
+            for event in due:
+                logger.debug("Sending event %r" % (event,))
+                try:
+                    await channel_layer.group_send("event", event)
+                    self.count("sent")
+                except Exception:
+                    logger.exception("Failed to send event")
+
+            timeout = None if next_due is None else max(next_due - time.monotonic(), 0)
+
+
+_event_publisher = None
+_event_publisher_pid = None
+_event_publisher_lock = threading.Lock()
+
+
+def get_event_publisher():
+    """The event publisher of this process, a forked process gets its own"""
+    global _event_publisher, _event_publisher_pid
+    with _event_publisher_lock:
+        if _event_publisher is None or _event_publisher_pid != os.getpid():
+            _event_publisher = EventPublisher(1 / settings.PROGRESS_UPDATES_PER_SECOND)
+            _event_publisher_pid = os.getpid()
+    return _event_publisher
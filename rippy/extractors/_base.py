@@ -1,16 +1,93 @@
+import asyncio
+
 from abc import ABCMeta, abstractmethod, abstractproperty
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from pyppeteer import errors
+
+from ..muxer import MP4
+from ..spans import job_span
 
 
 class JobFailedException(Exception):
     """For some reason we could not complete the job"""
 
 
+class ExtractionCancelledException(Exception):
+    """The page or browser went away while extracting"""
+
+
+class SuspendExtraction(Exception):
+    """Park the page in the browser and continue extraction with resume later"""
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.state = state
+
+
+def host_matches(hostname, hosts):
+    return any(hostname == host or hostname.endswith("." + host) for host in hosts)
+
+
+class ResponseWaiter:
+    """Collects page responses matching predicate as they arrive"""
+
+    def __init__(self, page, predicate, handler=None):
+        self.predicate = predicate
+        self.handler = handler
+        self.results = []
+        self.changed = asyncio.Event()
+        page.on("response", self.on_response)
+
+    async def on_response(self, response):
+        if not self.predicate(response):
+            return
+
+        if self.handler:
+            self.results.append(await self.handler(response))
+        else:
+            self.results.append(response)
+        self.changed.set()
+
+    @property
+    def count(self):
+        return len(self.results)
+
+    async def wait(self, count=1):
+        """Wait until at least count responses have matched"""
+        while self.count < count:
+            self.changed.clear()
+            await self.changed.wait()
+        return self.results[count - 1]
+
+
 class BaseExtractor(metaclass=ABCMeta):
     cancelled = False
 
+    # Seconds an extraction result can be reused for the same url, 0 disables it
+    cache_ttl = 0
+
+    # How segments are merged when the job does not say, see muxer.OUTPUT_FORMATS
+    output_format = MP4
+
+    # Extractors that do not need a browser are called with page set to None
+    requires_browser = True
+
+    # Extractors implementing resume can have waiting jobs suspended
+    supports_suspend = False
+
+    # Request interception rules, a host also matches its subdomains.
+    # Requests to allowed_hosts are never blocked, otherwise requests
+    # for blocked_resource_types or to blocked_hosts are aborted.
+    blocked_resource_types = ()
+    allowed_hosts = ()
+    blocked_hosts = ()
+
     def __init__(self, job, page):
         self.job = job
         self.page = page
+        self.cancelled_event = asyncio.Event()
 
     @abstractproperty
     def name(self):
@@ -28,7 +105,106 @@ class BaseExtractor(metaclass=ABCMeta):
     async def extract(self, job):
         """Extract data from job"""
 
-    def wait_for_user_input(self, reason):
+    def span(self, name):
+        """Time a step of the extraction, shown in the timeline of the job"""
+        return job_span(self.job, name)
+
+    def cancel(self):
+        self.cancelled = True
+        self.cancelled_event.set()
+
+    async def wait_for_any(self, awaitables, timeout=None):
+        """
+        Wait for the first of awaitables to finish and return its index.
+        Raises asyncio.TimeoutError on timeout and ExtractionCancelledException
+        if the extraction is cancelled meanwhile.
+        """
+        futures = [asyncio.ensure_future(aw) for aw in awaitables]
+        cancelled = asyncio.ensure_future(self.cancelled_event.wait())
+        try:
+            done, _ = await asyncio.wait(
+                futures + [cancelled],
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            for future in futures + [cancelled]:
+                if not future.done():
+                    future.cancel()
+
+        for i, future in enumerate(futures):
+            if future in done:
+                future.result()
+                return i
+
+        if cancelled in done:
+            raise ExtractionCancelledException()
+        raise asyncio.TimeoutError()
+
+    async def wait_for(self, awaitable, timeout=None):
+        """Wait for awaitable and return its result, see wait_for_any"""
+        future = asyncio.ensure_future(awaitable)
+        await self.wait_for_any([future], timeout)
+        return future.result()
+
+    def watch_responses(self, predicate, handler=None):
+        """
+        Start collecting responses matching predicate, wait for them with
+        `await self.wait_for(waiter.wait(count), timeout)`.
+        """
+        return ResponseWaiter(self.page, predicate, handler)
+
+    async def wait_for_element(self, selector, hidden=False):
+        """Wait for an element to appear, or disappear if hidden is set"""
+        await self.page.waitForSelector(selector, {"hidden": hidden, "timeout": 0})
+
+    async def resume(self, state):
+        """
+        Continue a suspended extraction, state is what was passed to
+        wait_for_user_input. Only called if supports_suspend is set.
+        """
+        raise JobFailedException("%s cannot resume extractions" % (self.name,))
+
+    def wait_for_user_input(self, reason, state=None):
+        """
+        Tell the user to do something in the browser. If state is passed and
+        waiting jobs are suspended, the extraction stops here and resume is
+        later called with state by the suspended job watcher.
+        """
         self.job.status = self.job.WAITING
         self.job.status_message = reason
         self.job.save()
+
+        if (
+            state is not None
+            and settings.SUSPEND_WAITING_JOBS
+            and self.supports_suspend
+        ):
+            raise SuspendExtraction(state)
+
+    def is_request_allowed(self, url, resource_type):
+        hostname = urlsplit(url).hostname or ""
+        if host_matches(hostname, self.allowed_hosts):
+            return True
+
+        if resource_type in self.blocked_resource_types:
+            return False
+
+        return not host_matches(hostname, self.blocked_hosts)
+
+    async def handle_request(self, request):
+        try:
+            if self.is_request_allowed(request.url, request.resourceType):
+                await request.continue_()
+            else:
+                await request.abort()
+        except errors.NetworkError:
+            pass
+
+    async def setup_request_interception(self):
+        """Only let the requests needed to extract the media through"""
+        if not self.blocked_resource_types and not self.blocked_hosts:
+            return
+
+        await self.page.setRequestInterception(True)
+        self.page.on("request", self.handle_request)
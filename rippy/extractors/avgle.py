@@ -15,22 +15,46 @@ class AvgleExtractor(BaseExtractor):
     name = "Avgle"
     matcher = re.compile(r"^https?://(www\.)?avgle.com/video/([^/]{6,})/.*")
     priority = 10
+    cache_ttl = 15 * 60
+    supports_suspend = True
+
+    blocked_resource_types = ("image", "media", "font", "stylesheet")
+    allowed_hosts = ("google.com", "gstatic.com", "recaptcha.net")
+    blocked_hosts = (
+        "doubleclick.net",
+        "exoclick.com",
+        "exosrv.com",
+        "google-analytics.com",
+        "googletagmanager.com",
+        "juicyads.com",
+        "trafficjunky.net",
+    )
+
+    captcha_selector = 'iframe[src*="google.com/recaptcha"]'
+
+    def watch_video_urls(self):
+        async def parse_video_url(r):
+            logger.debug("Got response that matches correct URL, %s" % (r.url,))
+            d = json.loads(await r.text())
+            s3 = parse_qs(urlparse(d["url"]).query)["s3"][0]
+            return base64.b64decode(s3).decode("utf-8")
+
+        return self.watch_responses(
+            lambda r: "//avgle.com/video-url.php?" in r.url, parse_video_url
+        )
 
-    async def extract(self):
-        state = {"count": 0}
+    def create_result(self, url, title, id_):
+        headers = {}
+        if "ahcdn.com" not in url:
+            headers["Referer"] = "http://avg" + "le.com"
 
-        async def handle_response(r):
-            if "//avgle.com/video-url.php?" in r.url:
-                logger.debug("Got response that matches correct URL, %s" % (r.url,))
-                d = json.loads(await r.text())
-                state["url"] = base64.b64decode(
-                    parse_qs(urlparse(d["url"]).query)["s3"][0]
-                ).decode("utf-8")
-                state["count"] += 1
+        return {"url": url, "title": title, "id": id_, "headers": headers}
 
-        self.page.on("response", handle_response)
+    async def extract(self):
+        video_urls = self.watch_video_urls()
 
-        await self.page.goto(self.job.url, waitUntil="networkidle2")
+        with self.span("page_load"):
+            await self.page.goto(self.job.url, waitUntil="networkidle2")
 
         element = await self.page.querySelector("title")
         title = (
@@ -40,43 +64,62 @@ class AvgleExtractor(BaseExtractor):
         )
         id_ = self.job.url.split("/")[4]
 
-        for _ in range(10):
-            if state.get("url"):
-                break
-            await asyncio.sleep(1)
+        try:
+            await self.wait_for(video_urls.wait(1), timeout=10)
+        except asyncio.TimeoutError:
+            pass
 
-        found_recaptcha_count = 0
-        found_recaptcha = await self.page.querySelector(
-            'iframe[src*="google.com/recaptcha"]'
-        )
+        found_recaptcha = await self.page.querySelector(self.captcha_selector)
         if found_recaptcha:
             logger.info("We need a captcha response")
-            self.wait_for_user_input("Please input captcha")
-            for _ in range(3200):
-                if state["count"] == 2:
-                    break
-
-                if self.cancelled:
-                    return
-
-                found_recaptcha = await self.page.querySelector(
-                    'iframe[src*="google.com/recaptcha"]'
+            self.wait_for_user_input(
+                "Please input captcha", state={"title": title, "id": id_}
+            )
+            with self.span("captcha"):
+                await self.wait_for_captcha(video_urls, 2)
+
+        if not video_urls.count:
+            raise JobFailedException("Failed to find video url")
+
+        return self.create_result(video_urls.results[-1], title, id_)
+
+    async def resume(self, state):
+        video_urls = self.watch_video_urls()
+        with self.span("captcha"):
+            await self.wait_for_captcha(video_urls, 1)
+
+        return self.create_result(video_urls.results[-1], state["title"], state["id"])
+
+    async def wait_for_captcha(self, video_urls, count):
+        """Wait for the video url that is requested when the captcha is solved"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + 3200
+        while True:
+            try:
+                solved = await self.wait_for_any(
+                    [
+                        video_urls.wait(count),
+                        self.wait_for_element(self.captcha_selector, hidden=True),
+                    ],
+                    timeout=deadline - loop.time(),
                 )
-                if found_recaptcha:
-                    found_recaptcha_count = 0
-                else:
-                    found_recaptcha_count += 1
-
-                if found_recaptcha_count > 7:
-                    raise JobFailedException("Recaptcha gone for too long, failing job")
-
-                logger.debug("Is captcha still visible: %r" % (found_recaptcha,))
-                await asyncio.sleep(1)
-            else:
+            except asyncio.TimeoutError:
                 raise JobFailedException("Failed while waiting for captcha")
 
-        headers = {}
-        if "ahcdn.com" not in state["url"]:
-            headers["Referer"] = "http://avg" + "le.com"
+            if solved == 0:
+                return
+
+            logger.debug("Captcha is gone, waiting for it to come back or video url")
+            try:
+                solved = await self.wait_for_any(
+                    [
+                        video_urls.wait(count),
+                        self.wait_for_element(self.captcha_selector),
+                    ],
+                    timeout=8,
+                )
+            except asyncio.TimeoutError:
+                raise JobFailedException("Recaptcha gone for too long, failing job")
 
-        return {"url": state["url"], "title": title, "id": id_, "headers": headers}
+            if solved == 0:
+                return
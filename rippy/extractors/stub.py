@@ -0,0 +1,23 @@
+import re
+
+from ._base import BaseExtractor
+
+
+class StubExtractor(BaseExtractor):
+    """
+    Uses the job url as the media url without a browser, used by the
+    benchmark_jobs command and not registered in EXTRACTORS.
+    """
+
+    name = "Stub"
+    matcher = re.compile(r"^https?://[^/]+/stub/.*")
+    priority = 0
+    requires_browser = False
+
+    async def extract(self):
+        return {
+            "url": self.job.url,
+            "title": "Stub %s" % (self.job.pk,),
+            "id": str(self.job.pk),
+            "headers": {},
+        }
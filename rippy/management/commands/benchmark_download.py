@@ -0,0 +1,130 @@
+import asyncio
+import concurrent.futures
+import os
+import tempfile
+import time
+
+import m3u8
+import requests
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...downloader import SegmentDownloader
+from ...playlist import get_segments
+from ...tasks import USER_AGENT
+
+
+def download_file_segment_threaded(url, byterange, target, headers):
+    """The old one-request-per-segment download, kept for comparison"""
+    size = 0
+    if byterange is not None:
+        offset, length = byterange
+        headers = dict(headers, Range="bytes=%s-%s" % (offset, offset + length - 1))
+    with requests.get(url, stream=True, headers=headers) as r:
+        with open(target, "wb") as f:
+            for chunk in r.iter_content(chunk_size=8192):
+                if chunk:
+                    f.write(chunk)
+                    size += len(chunk)
+    return size
+
+
+def download_threaded(segments, headers, concurrency, max_concurrency):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(
+                download_file_segment_threaded, url, byterange, target, headers
+            )
+            for url, byterange, target in segments
+        ]
+        return sum(future.result() for future in futures)
+
+
+def download_async(segments, headers, concurrency, max_concurrency):
+    async def download_segments():
+        async with SegmentDownloader(headers, concurrency) as downloader:
+            return await downloader.download(segments)
+
+    return asyncio.get_event_loop().run_until_complete(download_segments())
+
+
+def download_adaptive(segments, headers, concurrency, max_concurrency):
+    async def download_segments():
+        async with SegmentDownloader(
+            headers, concurrency, max_concurrency=max_concurrency
+        ) as downloader:
+            return await downloader.download(segments)
+
+    return asyncio.get_event_loop().run_until_complete(download_segments())
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the threaded and the async segment downloaders against a m3u8 playlist"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="URL to a media playlist")
+        parser.add_argument(
+            "--concurrency", type=int, default=settings.DOWNLOAD_CONCURRENCY
+        )
+        parser.add_argument(
+            "--max-concurrency",
+            type=int,
+            default=settings.DOWNLOAD_CONCURRENCY_MAX,
+            help="Upper bound for the adaptive downloader",
+        )
+        parser.add_argument(
+            "--segments", type=int, default=None, help="Only download the first N"
+        )
+        parser.add_argument(
+            "--header", action="append", default=[], help="Extra header, Key: Value"
+        )
+
+    def handle(self, *args, **options):
+        headers = {"User-Agent": USER_AGENT}
+        for header in options["header"]:
+            key, value = header.split(":", 1)
+            headers[key.strip()] = value.strip()
+
+        r = requests.get(options["url"], headers=headers)
+        playlist = m3u8.loads(r.text)
+        media_segments = get_segments(playlist, r.url)[: options["segments"]]
+        if not media_segments:
+            raise CommandError("No segments found in playlist")
+
+        downloaders = [
+            ("threaded", download_threaded),
+            ("async", download_async),
+            ("adaptive", download_adaptive),
+        ]
+        for name, func in downloaders:
+            with tempfile.TemporaryDirectory() as download_dir:
+                segments = [
+                    (
+                        segment.uri,
+                        segment.byterange,
+                        os.path.join(download_dir, f"{i:05}.ts"),
+                    )
+                    for i, segment in enumerate(media_segments)
+                ]
+                start_time = time.monotonic()
+                total_bytes = func(
+                    segments,
+                    headers,
+                    options["concurrency"],
+                    options["max_concurrency"],
+                )
+                elapsed = time.monotonic() - start_time
+
+            self.stdout.write(
+                "%-10s %6i segments in %7.2fs  %8.2f segments/s  %10.2f KiB/s"
+                % (
+                    name,
+                    len(segments),
+                    elapsed,
+                    len(segments) / elapsed,
+                    total_bytes / elapsed / 1024,
+                )
+            )
@@ -0,0 +1,228 @@
+import asyncio
+import os
+import random
+import resource
+import shutil
+import socket
+import threading
+import time
+
+from aiohttp import web
+from celery import current_app
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...extractors import EXTRACTORS
+from ...extractors.stub import StubExtractor
+from ...models import Job
+from ...muxer import CONCAT, MP4
+
+TS_NULL_PACKET = b"\x47\x1f\xff\x10" + b"\xff" * 184
+
+
+class SyntheticOrigin:
+    """
+    HLS origin serving generated playlists and segments from a background thread.
+    Every segment request waits `latency` seconds, is sent at most `bandwidth`
+    bytes per second and fails with a 500 with a probability of `failure_rate`.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, segments, segment_data, latency, bandwidth, failure_rate):
+        self.segments = segments
+        self.segment_data = segment_data
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+
+        app = web.Application()
+        app.router.add_get("/stub/{job}/playlist.m3u8", self.playlist)
+        app.router.add_get("/stub/{job}/{index}.ts", self.segment)
+        self.runner = web.AppRunner(app)
+
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+
+    async def serve(self):
+        await self.runner.setup()
+        await web.SockSite(self.runner, self.sock).start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def url(self, name):
+        return "http://127.0.0.1:%s/stub/%s/playlist.m3u8" % (self.port, name)
+
+    async def playlist(self, request):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2"]
+        for i in range(self.segments):
+            lines += ["#EXTINF:2.0,", "%s.ts" % (i,)]
+        lines.append("#EXT-X-ENDLIST")
+        return web.Response(
+            text="\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl"
+        )
+
+    async def segment(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return web.Response(status=500)
+
+        response = web.StreamResponse()
+        response.content_type = "video/mp2t"
+        response.content_length = len(self.segment_data)
+        await response.prepare(request)
+        for i in range(0, len(self.segment_data), self.chunk_size):
+            chunk = self.segment_data[i : i + self.chunk_size]
+            await response.write(chunk)
+            if self.bandwidth:
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+        await response.write_eof()
+        return response
+
+
+def get_bytes_written():
+    """Bytes this process caused to be written to disk"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "write_bytes":
+                    return int(value)
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_oublock * 512
+
+
+class Command(BaseCommand):
+    help = (
+        "Run jobs end to end against a local synthetic HLS origin, "
+        "using a stub extractor instead of the browser"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--jobs", type=int, default=5)
+        parser.add_argument("--segments", type=int, default=100)
+        parser.add_argument(
+            "--segment-size", type=int, default=256 * 1024, help="Bytes per segment"
+        )
+        parser.add_argument(
+            "--segment-file",
+            default=None,
+            help="Serve this MPEG-TS file as every segment instead of generated data",
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0.05, help="Seconds before a segment"
+        )
+        parser.add_argument(
+            "--bandwidth",
+            type=int,
+            default=0,
+            help="Bytes per second per segment request, 0 is unlimited",
+        )
+        parser.add_argument(
+            "--failure-rate",
+            type=float,
+            default=0,
+            help="Fraction of segment requests answered with a 500",
+        )
+        parser.add_argument(
+            "--output-format",
+            choices=[MP4, CONCAT],
+            default=CONCAT,
+            help="mp4 needs ffmpeg and --segment-file with real MPEG-TS",
+        )
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the jobs and their files"
+        )
+
+    def handle(self, *args, **options):
+        if options["segment_file"]:
+            with open(options["segment_file"], "rb") as f:
+                segment_data = f.read()
+        else:
+            packets = max(options["segment_size"] // len(TS_NULL_PACKET), 1)
+            segment_data = TS_NULL_PACKET * packets
+
+        if options["output_format"] == MP4 and shutil.which("ffmpeg") is None:
+            raise CommandError("ffmpeg not found")
+
+        # Run the job stages in this process and keep events away from redis
+        current_app.conf.task_always_eager = True
+        settings.CHANNEL_LAYERS = {
+            "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+        }
+
+        origin = SyntheticOrigin(
+            options["segments"],
+            segment_data,
+            options["latency"],
+            options["bandwidth"],
+            options["failure_rate"],
+        )
+        origin.start()
+        EXTRACTORS.append(StubExtractor)
+
+        jobs = []
+        bytes_written = get_bytes_written()
+        start_time = time.monotonic()
+        try:
+            for i in range(options["jobs"]):
+                job = Job.objects.create(
+                    url=origin.url(i), output_format=options["output_format"]
+                )
+                job.refresh_from_db()
+                jobs.append(job)
+                self.stdout.write(
+                    "Job %s %s in %.2fs: %s"
+                    % (
+                        job.pk,
+                        job.status,
+                        sum(span.duration for span in job.spans.all()),
+                        job.status_message,
+                    )
+                )
+        finally:
+            elapsed = time.monotonic() - start_time
+            bytes_written = get_bytes_written() - bytes_written
+            EXTRACTORS.remove(StubExtractor)
+            origin.stop()
+
+            if not options["keep"]:
+                for job in jobs:
+                    shutil.rmtree(
+                        os.path.join(settings.MEDIA_ROOT, str(job.pk)),
+                        ignore_errors=True,
+                    )
+                    job.delete()
+
+        succeeded = sum(1 for job in jobs if job.status == Job.SUCCESS)
+        segments = succeeded * options["segments"]
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        self.stdout.write(
+            "%s of %s jobs succeeded in %.2fs" % (succeeded, len(jobs), elapsed)
+        )
+        self.stdout.write("%10.2f jobs/min" % (len(jobs) / elapsed * 60,))
+        self.stdout.write("%10.2f segments/s" % (segments / elapsed,))
+        self.stdout.write("%10.2f MiB peak RSS" % (peak_rss,))
+        self.stdout.write("%10.2f MiB written to disk" % (bytes_written / 1024 / 1024,))
+        self.stdout.write(
+            "%10i segment requests, %s failed by the origin"
+            % (origin.requests, origin.failures)
+        )
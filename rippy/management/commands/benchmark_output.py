@@ -0,0 +1,103 @@
+import asyncio
+import os
+import tempfile
+import time
+
+import m3u8
+import requests
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...downloader import SegmentDownloader
+from ...muxer import concat_stream
+from ...playlist import get_segments, is_fragmented_mp4
+from ...tasks import USER_AGENT, mux_files
+
+
+def output_ffmpeg(segments, headers, concurrency, work_dir):
+    """Download segments to files and remux them into a mp4 with ffmpeg"""
+    targets = [os.path.join(work_dir, f"{i:05}.ts") for i in range(len(segments))]
+
+    async def download_segments():
+        async with SegmentDownloader(headers, concurrency) as downloader:
+            return await downloader.download(
+                [
+                    (segment.uri, segment.byterange, target)
+                    for segment, target in zip(segments, targets)
+                ]
+            )
+
+    asyncio.get_event_loop().run_until_complete(download_segments())
+
+    target = os.path.join(work_dir, "output.mp4")
+    returncode = mux_files(targets, target)
+    if returncode:
+        raise CommandError("ffmpeg failed with returncode %s" % (returncode,))
+    return target
+
+
+def output_concat(segments, headers, concurrency, work_dir):
+    """Write segments straight into the output file as they are downloaded"""
+    target = os.path.join(work_dir, "output")
+
+    async def stream_segments():
+        async with SegmentDownloader(headers, concurrency) as downloader:
+            return await concat_stream(
+                downloader.iter_segments(
+                    [(segment.uri, segment.byterange) for segment in segments],
+                    settings.STREAM_BUFFER_SEGMENTS,
+                ),
+                target,
+            )
+
+    asyncio.get_event_loop().run_until_complete(stream_segments())
+    return target
+
+
+class Command(BaseCommand):
+    help = "Compare merging segments with ffmpeg against concatenating them as is"
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="URL to a media playlist")
+        parser.add_argument(
+            "--concurrency", type=int, default=settings.DOWNLOAD_CONCURRENCY
+        )
+        parser.add_argument(
+            "--segments", type=int, default=None, help="Only download the first N"
+        )
+        parser.add_argument(
+            "--header", action="append", default=[], help="Extra header, Key: Value"
+        )
+
+    def handle(self, *args, **options):
+        headers = {"User-Agent": USER_AGENT}
+        for header in options["header"]:
+            key, value = header.split(":", 1)
+            headers[key.strip()] = value.strip()
+
+        r = requests.get(options["url"], headers=headers)
+        playlist = m3u8.loads(r.text)
+        segments = get_segments(playlist, r.url)[: options["segments"]]
+        if not segments:
+            raise CommandError("No segments found in playlist")
+
+        if is_fragmented_mp4(playlist):
+            self.stdout.write("Playlist has fragmented mp4 segments")
+
+        outputs = [("ffmpeg", output_ffmpeg), ("concat", output_concat)]
+        for name, func in outputs:
+            with tempfile.TemporaryDirectory() as work_dir:
+                start_time = time.monotonic()
+                try:
+                    target = func(segments, headers, options["concurrency"], work_dir)
+                except FileNotFoundError as e:
+                    self.stdout.write("%-10s skipped, %s" % (name, e))
+                    continue
+                elapsed = time.monotonic() - start_time
+                size = os.path.getsize(target)
+
+            self.stdout.write(
+                "%-10s %6i segments in %7.2fs  %10.2f KiB output  %10.2f KiB/s"
+                % (name, len(segments), elapsed, size / 1024, size / elapsed / 1024)
+            )
@@ -8,7 +8,20 @@ class Command(BaseCommand):
         "Cleanup job with an active status, can be used after rippy has been shut down"
     )
 
-    def handle(self, *args, **options):
-        Job.objects.exclude(status__in=[Job.SUCCESS, Job.FAILED, Job.CANCELLED]).update(
-            status=Job.FAILED, status_message="Job cleaned up"
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retry",
+            action="store_true",
+            help="Schedule the jobs again, already downloaded segments are kept",
         )
+
+    def handle(self, *args, **options):
+        jobs = Job.objects.exclude(status__in=[Job.SUCCESS, Job.FAILED, Job.CANCELLED])
+        if options["retry"]:
+            for job in jobs:
+                job.status = Job.PENDING
+                job.status_message = "Job resumed"
+                job.scheduled = False
+                job.save()
+        else:
+            jobs.update(status=Job.FAILED, status_message="Job cleaned up")
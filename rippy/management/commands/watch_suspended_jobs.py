@@ -0,0 +1,12 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from ...watcher import SuspendedJobWatcher
+
+
+class Command(BaseCommand):
+    help = "Continue jobs suspended while waiting for user-input, e.g. a captcha"
+
+    def handle(self, *args, **options):
+        asyncio.get_event_loop().run_until_complete(SuspendedJobWatcher().run())
@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentManifest:
+    """
+    Persistent record of the segments of a job that are already downloaded.
+
+    Segments are keyed on their position and the path of their URI.
+    The hostname and query string are ignored as they usually contain
+    the CDN node and signature, both which change when a job is re-extracted.
+    """
+
+    filename = "manifest.jsonl"
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, self.filename)
+        self.segments = {}
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning("Skipping broken manifest line %r" % (line,))
+                        continue
+                    self.segments[entry["key"]] = entry
+
+        self.f = open(self.manifest_path, "a")
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def key(self, index, uri):
+        return "%s:%s" % (index, urlsplit(uri).path)
+
+    def target(self, index):
+        return os.path.join(self.path, f"{index:05}.ts")
+
+    def is_complete(self, index, uri):
+        """Check if the segment is downloaded and still has the size we recorded"""
+        entry = self.segments.get(self.key(index, uri))
+        if not entry:
+            return False
+
+        target = self.target(index)
+        return os.path.isfile(target) and os.path.getsize(target) == entry["size"]
+
+    def mark_complete(self, index, uri, size):
+        entry = {"key": self.key(index, uri), "size": size}
+        self.segments[entry["key"]] = entry
+        self.f.write(json.dumps(entry) + "\n")
+        self.f.flush()
+
+
+class RangeManifest(SegmentManifest):
+    """
+    Persistent record of the byte ranges of a single file that are already
+    downloaded, keyed on the range and the size of the complete file.
+    """
+
+    filename = "ranges.jsonl"
+
+    def __init__(self, path, size):
+        super().__init__(path)
+        self.size = size
+
+    def key(self, byterange, uri):
+        offset, length = byterange
+        return "%s+%s/%s:%s" % (offset, length, self.size, urlsplit(uri).path)
+
+    def is_complete(self, byterange, uri):
+        entry = self.segments.get(self.key(byterange, uri))
+        return entry is not None and entry["size"] == byterange[1]
@@ -0,0 +1,147 @@
+import logging
+
+from django.conf import settings
+from django.db.models import Count
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    start_http_server,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_LATENCY = Histogram(
+    "rippy_segment_latency_seconds",
+    "Time to download a segment",
+    ["host"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+)
+SEGMENT_SIZE = Histogram(
+    "rippy_segment_size_bytes",
+    "Size of downloaded segments",
+    ["host"],
+    buckets=tuple(2 ** i * 64 * 1024 for i in range(10)),
+)
+DOWNLOADED_BYTES = Counter(
+    "rippy_downloaded_bytes", "Bytes of segments downloaded", ["host"]
+)
+SEGMENT_RETRIES = Counter(
+    "rippy_segment_retries", "Segment requests that failed and were retried", ["host"]
+)
+SEGMENT_FAILURES = Counter(
+    "rippy_segment_failures", "Segments that failed after all retries", ["host"]
+)
+BROWSER_CONNECT = Histogram(
+    "rippy_browser_connect_seconds", "Time to connect to the browser"
+)
+EVENTS = Counter(
+    "rippy_events",
+    "Events by what happened to them: published, merged, dropped or sent",
+    ["outcome"],
+)
+EVENT_QUEUE_DEPTH = Gauge(
+    "rippy_event_queue_depth",
+    "Events waiting to be sent to the channel layer",
+    multiprocess_mode="livesum",
+)
+JOB_STEP = Histogram(
+    "rippy_job_step_seconds",
+    "Time spent in a step of a job, e.g. extract or mux",
+    ["extractor", "step"],
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+
+class JobStatusCollector:
+    """Number of jobs in each status, counted in the database when scraped"""
+
+    def collect(self):
+        from .models import Job
+
+        metric = GaugeMetricFamily("rippy_jobs", "Jobs per status", labels=["status"])
+        counts = dict(
+            Job.objects.values_list("status").annotate(count=Count("id")).order_by()
+        )
+        for status, _ in Job._meta.get_field("status").choices:
+            metric.add_metric([status], counts.get(status, 0))
+        yield metric
+
+
+# Workers of each queue on the same host serve their metrics on their own port,
+# RIPPY_WORKER_METRICS_PORT plus the offset of the first queue they consume
+WORKER_PORT_OFFSETS = {"extract": 0, "download": 1, "mux": 2}
+
+
+class ExtractionCacheCollector:
+    """Extraction cache lookups of all processes, counted in redis"""
+
+    def collect(self):
+        from .cache import extraction_cache
+
+        try:
+            stats = extraction_cache.stats()
+        except RedisError:
+            logger.warning("Unable to get extraction cache stats from redis")
+            return
+
+        metric = CounterMetricFamily(
+            "rippy_extraction_cache",
+            "Extraction cache hits, misses and invalidations",
+            labels=["result"],
+        )
+        for result, value in sorted(stats.items()):
+            metric.add_metric([result], value)
+        yield metric
+
+
+job_registry = CollectorRegistry()
+job_registry.register(JobStatusCollector())
+job_registry.register(ExtractionCacheCollector())
+
+
+def get_registry():
+    """
+    Registry with the metrics of all processes when RIPPY_METRICS_DIR is set,
+    otherwise only the metrics of this process.
+    """
+    if not settings.METRICS_DIR:
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry, path=settings.METRICS_DIR)
+    return registry
+
+
+def generate_metrics():
+    return generate_latest(get_registry()) + generate_latest(job_registry)
+
+
+def get_worker_port(queues):
+    offsets = [WORKER_PORT_OFFSETS.get(queue, 0) for queue in queues]
+    return settings.WORKER_METRICS_PORT + min(offsets, default=0)
+
+
+def start_worker_exporter(queues):
+    """
+    Serve the metrics of a worker consuming queues on its port, see
+    WORKER_PORT_OFFSETS. Not needed when the web process shares METRICS_DIR.
+    """
+    if not settings.WORKER_METRICS_PORT:
+        return
+
+    if not settings.METRICS_DIR:
+        logger.warning("RIPPY_METRICS_DIR is not set, only exporting the main process")
+
+    port = get_worker_port(queues)
+    logger.info("Serving worker metrics on port %s" % (port,))
+    try:
+        start_http_server(port, registry=get_registry())
+    except OSError:
+        logger.exception("Unable to serve worker metrics on port %s" % (port,))
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rippy', '0009_auto_20190719_1505'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='suspended_state',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rippy', '0010_job_suspended_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='max_bandwidth',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='max_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='variant_policy',
+            field=models.CharField(choices=[('highest', 'Highest bandwidth'), ('lowest', 'Lowest bandwidth'), ('max_bandwidth', 'Highest bandwidth below a cap'), ('max_resolution', 'Highest bandwidth below a resolution')], default='highest', max_length=20),
+        ),
+    ]
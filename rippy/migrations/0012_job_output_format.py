@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rippy', '0011_job_variant_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='output_format',
+            field=models.CharField(blank=True, choices=[('mp4', 'Remux into mp4 with ffmpeg'), ('concat', 'Concatenate segments as is, .ts or fragmented mp4')], default='', max_length=20),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rippy', '0012_job_output_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='rippy.Job'),
+        ),
+        migrations.CreateModel(
+            name='Media',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('extractor', models.CharField(max_length=100)),
+                ('media_id', models.CharField(max_length=500)),
+                ('variant', models.CharField(max_length=200)),
+                ('complete', models.BooleanField(default=False)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media', to='rippy.Job')),
+            ],
+            options={
+                'unique_together': {('extractor', 'media_id', 'variant')},
+            },
+        ),
+    ]
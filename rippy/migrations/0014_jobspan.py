@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rippy', '0013_media'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='extractor',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.CreateModel(
+            name='JobSpan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('started', models.DateTimeField()),
+                ('ended', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('failed', models.BooleanField(default=False)),
+                ('bytes', models.BigIntegerField(null=True)),
+                ('segments', models.PositiveIntegerField(null=True)),
+                ('retries', models.PositiveIntegerField(null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='spans', to='rippy.Job')),
+            ],
+            options={
+                'ordering': ['started', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rippy', '0014_jobspan'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['hidden', '-id'], name='job_hidden_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['hidden', 'status', '-id'], name='job_hidden_status_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['hidden', 'last_updated'], name='job_hidden_updated_idx'),
+        ),
+    ]
@@ -1,11 +1,14 @@
 import logging
+import shutil
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from .events import get_event_publisher
+from .muxer import OUTPUT_FORMATS
+from .playlist import HIGHEST, VARIANT_POLICIES
+
 logger = logging.getLogger(__name__)
 
 
@@ -37,39 +40,128 @@ class Job(models.Model):
     path = models.FileField(null=True)
     name = models.CharField(max_length=500, null=True)
 
+    # Which variant of a master playlist to download,
+    # caps are in bits per second and pixels
+    variant_policy = models.CharField(
+        max_length=20, choices=VARIANT_POLICIES, default=HIGHEST
+    )
+    max_bandwidth = models.PositiveIntegerField(null=True, blank=True)
+    max_height = models.PositiveIntegerField(null=True, blank=True)
+
+    # How segments are merged, blank uses the default of the extractor
+    output_format = models.CharField(
+        max_length=20, choices=OUTPUT_FORMATS, blank=True, default=""
+    )
+
     hidden = models.BooleanField(default=False)
     scheduled = models.BooleanField(default=False)
 
+    # Where to find the page of a job waiting for user-input after its task exited
+    suspended_state = models.TextField(blank=True, default="")
+
+    # Name of the extractor handling the job
+    extractor = models.CharField(max_length=100, blank=True, default="")
+
+    # Job downloading the same media this job waits for
+    duplicate_of = models.ForeignKey(
+        "self",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="duplicates",
+    )
+
     last_updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
 
+    # Jobs added in bulk are announced together, not by post_save, see JobViewSet.bulk
+    bulk_added = False
+
     class Meta:
         ordering = ["-id"]
+        # The job list filters on hidden and status and clients poll for changes
+        indexes = [
+            models.Index(fields=["hidden", "-id"], name="job_hidden_id_idx"),
+            models.Index(
+                fields=["hidden", "status", "-id"], name="job_hidden_status_id_idx"
+            ),
+            models.Index(
+                fields=["hidden", "last_updated"], name="job_hidden_updated_idx"
+            ),
+        ]
 
     def send_event(self, event_type, **kwargs):
-        kwargs["type"] = event_type
-        kwargs["id"] = self.pk
-        channel_layer = get_channel_layer()
-        logger.debug("Sending event %r" % (kwargs,))
-        async_to_sync(channel_layer.group_send)("event", kwargs)
+        get_event_publisher().publish(self.pk, event_type, **kwargs)
+
+    def send_progress_update(self, total, progress, **kwargs):
+        """Progress updates are throttled, only the latest is sent"""
+        self.send_event("job.progress", total=total, progress=progress, **kwargs)
+
+
+class Media(models.Model):
+    """
+    Index of media downloaded by jobs, a job finding media that is already
+    downloaded, or being downloaded, by another job reuses it.
+    """
+
+    extractor = models.CharField(max_length=100)
+    media_id = models.CharField(max_length=500)
+    variant = models.CharField(max_length=200)
+
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name="media")
+    complete = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (("extractor", "media_id", "variant"),)
 
-    def send_progress_update(self, total, progress):
-        self.send_event("job.progress", total=total, progress=progress)
+
+class JobSpan(models.Model):
+    """A timed step of a job, e.g. loading the page or downloading segments"""
+
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name="spans")
+    name = models.CharField(max_length=50)
+
+    started = models.DateTimeField()
+    ended = models.DateTimeField()
+    duration = models.FloatField()
+    failed = models.BooleanField(default=False)
+
+    bytes = models.BigIntegerField(null=True)
+    segments = models.PositiveIntegerField(null=True)
+    retries = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        ordering = ["started", "id"]
 
 
 @receiver(post_save, sender=Job)
-def event_job_update(sender, instance, created, **kwargs):
-    from .tasks import handle_job
-    from .views import JobSerializer
+def release_job_media(sender, instance, **kwargs):
+    from .dedup import release_media
 
-    payload = JobSerializer(instance).data
+    if instance.status in (Job.SUCCESS, Job.FAILED, Job.CANCELLED):
+        release_media(instance)
 
-    import threading
 
-    def job_update():
-        instance.send_event("job.update", **payload)
+@receiver(post_save, sender=Job)
+def remove_job_scratch(sender, instance, **kwargs):
+    """Failed jobs keep their downloaded segments so a retry can resume"""
+    from .tasks import get_scratch_path
+
+    if instance.status == Job.CANCELLED:
+        shutil.rmtree(get_scratch_path(instance), ignore_errors=True)
+
+
+@receiver(post_save, sender=Job)
+def event_job_update(sender, instance, created, **kwargs):
+    from .tasks import handle_job
+    from .views import JobEventSerializer
+
+    if instance.bulk_added:
+        return
 
-    threading.Thread(target=job_update).start()
+    instance.send_event("job.update", **JobEventSerializer(instance).data)
+    if instance.status in (Job.SUCCESS, Job.FAILED, Job.CANCELLED):
+        get_event_publisher().forget(instance.pk)
 
     if not instance.scheduled:
         instance.scheduled = True
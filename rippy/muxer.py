@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MP4 = "mp4"
+CONCAT = "concat"
+
+OUTPUT_FORMATS = (
+    (MP4, "Remux into mp4 with ffmpeg"),
+    (CONCAT, "Concatenate segments as is, .ts or fragmented mp4"),
+)
+
+
+def get_partial_path(target):
+    return target + ".partial"
+
+
+def replace_output(target, complete):
+    """
+    Move the partial output of target into place if it is complete, otherwise
+    remove it. A new inode replaces target so hardlinks to the earlier file,
+    e.g. from jobs that reused the media, keep their content.
+    """
+    partial_path = get_partial_path(target)
+    if complete:
+        os.replace(partial_path, target)
+    elif os.path.exists(partial_path):
+        os.remove(partial_path)
+
+
+def parse_number(value, suffix):
+    """Parse values like 1.5x and 1234.5kbits/s, None when ffmpeg reports N/A"""
+    try:
+        return float(value.strip()[: -len(suffix)])
+    except ValueError:
+        return None
+
+
+def iter_progress(lines):
+    """
+    Parse the key=value blocks ffmpeg writes with -progress, yields the time
+    written in seconds, the speed as a multiple of realtime, the bitrate in
+    kbit/s and if ffmpeg is done after every block.
+    """
+    block = {}
+    for line in lines:
+        key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+        if key != "progress":
+            block[key] = value
+            continue
+
+        out_time = block.get("out_time_us", block.get("out_time_ms", ""))
+        yield {
+            "time": int(out_time) / 1000000 if out_time.isdigit() else None,
+            "speed": parse_number(block.get("speed", "N/A"), "x"),
+            "bitrate": parse_number(block.get("bitrate", "N/A"), "kbits/s"),
+            "done": value == "end",
+        }
+        block = {}
+
+
+async def mux_stream(chunks, target):
+    """
+    Feed an async iterator of MPEG-TS data into ffmpeg's stdin and remux it
+    into a mp4 at target. Returns ffmpeg's returncode.
+    """
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-i",
+        "pipe:0",
+        "-c",
+        "copy",
+        "-f",
+        "mp4",
+        get_partial_path(target),
+    ]
+
+    logger.debug("Streaming segments into ffmpeg")
+    p = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stderr = asyncio.ensure_future(p.stderr.read())
+
+    try:
+        async for chunk in chunks:
+            p.stdin.write(chunk)
+            await p.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        logger.warning("ffmpeg stopped reading from stdin")
+    except BaseException:
+        p.kill()
+        await p.wait()
+        replace_output(target, False)
+        raise
+    else:
+        p.stdin.close()
+    finally:
+        await chunks.aclose()
+
+    returncode = await p.wait()
+    replace_output(target, not returncode)
+    if returncode:
+        logger.warning(
+            "ffmpeg failed with returncode %s: %s"
+            % (returncode, (await stderr).decode("utf-8", "replace"))
+        )
+    return returncode
+
+
+async def concat_stream(chunks, target):
+    """
+    Write an async iterator of segment data to target as is, MPEG-TS segments
+    and fragmented mp4 segments after their init section are valid when
+    concatenated. Returns number of bytes written.
+    """
+    size = 0
+    try:
+        with open(get_partial_path(target), "wb") as f:
+            async for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        replace_output(target, False)
+        raise
+    finally:
+        await chunks.aclose()
+    replace_output(target, True)
+    return size
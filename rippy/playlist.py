@@ -0,0 +1,160 @@
+import logging
+
+from urllib.parse import urljoin, urlsplit
+
+import m3u8
+
+logger = logging.getLogger(__name__)
+
+HIGHEST = "highest"
+LOWEST = "lowest"
+MAX_BANDWIDTH = "max_bandwidth"
+MAX_RESOLUTION = "max_resolution"
+
+VARIANT_POLICIES = (
+    (HIGHEST, "Highest bandwidth"),
+    (LOWEST, "Lowest bandwidth"),
+    (MAX_BANDWIDTH, "Highest bandwidth below a cap"),
+    (MAX_RESOLUTION, "Highest bandwidth below a resolution"),
+)
+
+
+PLAYLIST_CONTENT_TYPES = (
+    "application/vnd.apple.mpegurl",
+    "application/x-mpegurl",
+    "audio/mpegurl",
+    "audio/x-mpegurl",
+)
+
+
+class PlaylistException(Exception):
+    """The playlist could not be used"""
+
+
+class Segment:
+    """
+    A media segment with an absolute URI, an optional (offset, length) byte range
+    and its duration in seconds from EXTINF.
+    """
+
+    def __init__(self, uri, byterange=None, duration=None):
+        self.uri = uri
+        self.byterange = byterange
+        self.duration = duration
+
+
+def parse_byterange(byterange, range_ends, uri):
+    length, _, offset = byterange.partition("@")
+    length = int(length)
+    offset = int(offset) if offset else range_ends.get(uri, 0)
+    range_ends[uri] = offset + length
+    return offset, length
+
+
+def get_init_segment(playlist, base_uri):
+    """The EXT-X-MAP initialization section of fragmented mp4 playlists"""
+    segment_map = playlist.segment_map
+    if not segment_map or not segment_map.get("uri"):
+        return None
+
+    byterange = None
+    if segment_map.get("byterange"):
+        byterange = parse_byterange(segment_map["byterange"].strip('"'), {}, None)
+    return Segment(urljoin(base_uri, segment_map["uri"]), byterange)
+
+
+def get_segments(playlist, base_uri):
+    """
+    Media segments of a playlist with URIs relative to base_uri resolved,
+    starting with the initialization section if there is one. A byte range
+    without an offset starts where the previous range of the same URI ended.
+    """
+    init_segment = get_init_segment(playlist, base_uri)
+    segments = [init_segment] if init_segment else []
+    range_ends = {}
+    for segment in playlist.segments:
+        uri = urljoin(base_uri, segment.uri)
+        byterange = None
+        if segment.byterange:
+            byterange = parse_byterange(segment.byterange, range_ends, uri)
+        segments.append(Segment(uri, byterange, segment.duration))
+    return segments
+
+
+def get_height(variant):
+    resolution = variant.stream_info.resolution
+    if not resolution:
+        return None
+    return resolution[1]
+
+
+def select_variant(variants, policy, max_bandwidth=None, max_height=None):
+    """
+    Pick a variant of a master playlist, when nothing matches a cap
+    the variant closest to it is used.
+    """
+    variants = sorted(variants, key=lambda v: v.stream_info.bandwidth or 0)
+    if not variants:
+        raise PlaylistException("Master playlist has no variants")
+
+    if policy == LOWEST:
+        return variants[0]
+
+    if policy == MAX_BANDWIDTH and max_bandwidth:
+        matching = [
+            v for v in variants if (v.stream_info.bandwidth or 0) <= max_bandwidth
+        ]
+        return matching[-1] if matching else variants[0]
+
+    if policy == MAX_RESOLUTION and max_height:
+        matching = [v for v in variants if (get_height(v) or 0) <= max_height]
+        return matching[-1] if matching else variants[0]
+
+    return variants[-1]
+
+
+def is_fragmented_mp4(playlist):
+    return get_init_segment(playlist, "") is not None
+
+
+def is_playlist_response(r):
+    """Guess if a response is a playlist or a media file to download directly"""
+    content_type = r.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type in PLAYLIST_CONTENT_TYPES:
+        return True
+
+    if urlsplit(r.url).path.endswith(".m3u8"):
+        return True
+
+    return not (
+        content_type.startswith("video/")
+        or content_type == "audio/mp4"
+        or content_type == "application/octet-stream"
+    )
+
+
+def resolve_playlist(fetch, r, job):
+    """
+    Load the media playlist from response r, following a master playlist to
+    the variant chosen by the job. fetch is called with an URL and returns the
+    response. Returns the media playlist and its URI.
+    """
+    playlist = m3u8.loads(r.text)
+    if not playlist.is_variant:
+        return playlist, r.url
+
+    variant = select_variant(
+        playlist.playlists, job.variant_policy, job.max_bandwidth, job.max_height
+    )
+    variant_url = urljoin(r.url, variant.uri)
+    logger.info(
+        "Picked variant %s with bandwidth %s and resolution %s"
+        % (variant_url, variant.stream_info.bandwidth, variant.stream_info.resolution)
+    )
+
+    r = fetch(variant_url)
+    r.raise_for_status()
+    playlist = m3u8.loads(r.text)
+    if playlist.is_variant:
+        raise PlaylistException("Variant playlist is a master playlist")
+    return playlist, r.url
@@ -0,0 +1,195 @@
+import asyncio
+import threading
+import time
+import uuid
+
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from .store import get_redis
+
+ACQUIRE_SCRIPT = """
+local leases, bucket = KEYS[1], KEYS[2]
+local now, token = tonumber(ARGV[1]), ARGV[2]
+local connections, lease_ttl = tonumber(ARGV[3]), tonumber(ARGV[4])
+local rate, burst = tonumber(ARGV[5]), tonumber(ARGV[6])
+local connection_wait = tonumber(ARGV[7])
+
+if connections > 0 then
+    redis.call("ZREMRANGEBYSCORE", leases, "-inf", now)
+    if redis.call("ZCARD", leases) >= connections then
+        return tostring(connection_wait)
+    end
+end
+
+if rate > 0 then
+    local state = redis.call("HMGET", bucket, "tokens", "ts")
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+    if tokens < 1 then
+        return tostring((1 - tokens) / rate)
+    end
+    redis.call("HMSET", bucket, "tokens", tokens - 1, "ts", now)
+    redis.call("EXPIRE", bucket, math.ceil(burst / rate) + 1)
+end
+
+if connections > 0 then
+    redis.call("ZADD", leases, now + lease_ttl, token)
+    redis.call("EXPIRE", leases, math.ceil(lease_ttl) + 1)
+end
+
+return "0"
+"""
+
+
+class HostLimiter(metaclass=ABCMeta):
+    """
+    Limits requests per second, with a token bucket, and concurrent
+    connections per host. Connections are leases that expire after
+    `lease_ttl` seconds so a crashed worker does not hold them forever.
+    """
+
+    connection_wait = 0.1
+    lease_ttl = 120
+
+    def __init__(self, rate, burst, connections):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.connections = connections
+
+    @abstractmethod
+    def try_acquire(self, host, token):
+        """Returns 0 if acquired, otherwise seconds to wait before trying again"""
+
+    @abstractmethod
+    def release(self, host, token):
+        """Give back the connection acquired with token"""
+
+    def acquire(self, host):
+        token = uuid.uuid4().hex
+        while True:
+            wait = self.try_acquire(host, token)
+            if not wait:
+                return token
+            time.sleep(wait)
+
+    async def acquire_async(self, host):
+        loop = asyncio.get_event_loop()
+        token = uuid.uuid4().hex
+        while True:
+            wait = await loop.run_in_executor(None, self.try_acquire, host, token)
+            if not wait:
+                return token
+            await asyncio.sleep(wait)
+
+    async def release_async(self, host, token):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.release, host, token)
+
+    @contextmanager
+    def limit(self, host):
+        token = self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host, token)
+
+
+class RedisHostLimiter(HostLimiter):
+    """Limits shared by all workers using the same redis"""
+
+    prefix = "rippy:host:"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.script = get_redis().register_script(ACQUIRE_SCRIPT)
+
+    def try_acquire(self, host, token):
+        keys = [self.prefix + host + ":leases", self.prefix + host + ":bucket"]
+        args = [
+            time.time(),
+            token,
+            self.connections,
+            self.lease_ttl,
+            self.rate,
+            self.burst,
+            self.connection_wait,
+        ]
+        return float(self.script(keys=keys, args=args))
+
+    def release(self, host, token):
+        if self.connections:
+            get_redis().zrem(self.prefix + host + ":leases", token)
+
+
+class LocalHostLimiter(HostLimiter):
+    """Limits for this process only, useful without redis"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.leases = {}
+        self.buckets = {}
+
+    def try_acquire(self, host, token):
+        now = time.time()
+        with self.lock:
+            leases = self.leases.setdefault(host, {})
+            if self.connections:
+                for expired in [t for t, expires in leases.items() if expires <= now]:
+                    del leases[expired]
+                if len(leases) >= self.connections:
+                    return self.connection_wait
+
+            if self.rate:
+                tokens, ts = self.buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + max(now - ts, 0) * self.rate)
+                if tokens < 1:
+                    return (1 - tokens) / self.rate
+                self.buckets[host] = (tokens - 1, now)
+
+            if self.connections:
+                leases[token] = now + self.lease_ttl
+        return 0
+
+    def release(self, host, token):
+        with self.lock:
+            self.leases.get(host, {}).pop(token, None)
+
+
+_host_limiter = None
+
+
+def get_host_limiter():
+    """The configured host limiter, None if hosts are not limited"""
+    global _host_limiter
+    if not settings.HOST_RATE and not settings.HOST_CONNECTIONS:
+        return None
+
+    if _host_limiter is None:
+        if settings.HOST_LIMITER == "local":
+            limiter_cls = LocalHostLimiter
+        else:
+            limiter_cls = RedisHostLimiter
+        _host_limiter = limiter_cls(
+            settings.HOST_RATE,
+            settings.HOST_BURST or settings.HOST_RATE,
+            settings.HOST_CONNECTIONS,
+        )
+    return _host_limiter
+
+
+@contextmanager
+def limit_host(url):
+    """Hold a connection of the configured host limiter for the host of url"""
+    host_limiter = get_host_limiter()
+    if host_limiter is None:
+        yield
+        return
+
+    with host_limiter.limit(urlsplit(url).netloc):
+        yield
@@ -0,0 +1,42 @@
+import time
+
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from .metrics import JOB_STEP
+from .models import JobSpan
+
+
+@contextmanager
+def job_span(job, name, ok_exceptions=()):
+    """
+    Time a step of a job and store it as a JobSpan when the step is done.
+    Yields a dict to count bytes, segments and retries in.
+    Exceptions other than ok_exceptions mark the span as failed.
+    """
+    counters = {}
+    started = timezone.now()
+    start_time = time.monotonic()
+    failed = False
+    try:
+        yield counters
+    except ok_exceptions:
+        raise
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        duration = time.monotonic() - start_time
+        JOB_STEP.labels(job.extractor or "unknown", name).observe(duration)
+        JobSpan.objects.create(
+            job=job,
+            name=name,
+            started=started,
+            ended=timezone.now(),
+            duration=duration,
+            failed=failed,
+            bytes=counters.get("bytes"),
+            segments=counters.get("segments"),
+            retries=counters.get("retries"),
+        )
@@ -0,0 +1,13 @@
+import redis
+
+from django.conf import settings
+
+_redis = None
+
+
+def get_redis():
+    """Redis connection shared by the caches and limiters of this process"""
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.REDIS_URL)
+    return _redis
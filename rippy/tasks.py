@@ -1,102 +1,474 @@
 import asyncio
-import concurrent.futures
+import functools
+import json
 import logging
 import os
-import re
-import socket
+import shutil
 import subprocess
 import tempfile
+import threading
 import time
 
-import m3u8
+
 import requests
 
 from celery import shared_task
 from django.conf import settings
-from pyppeteer import connect, errors
+from pyppeteer import errors
 
+from .browser import USER_AGENT, BrowserUnavailableException, get_browser_pool
+from .cache import extraction_cache
+from .dedup import claim_media, get_variant_key
+from .downloader import FailedToDownloadSegmentException, SegmentDownloader
 from .extractors import EXTRACTORS
+from .extractors._base import (
+    ExtractionCancelledException,
+    JobFailedException,
+    SuspendExtraction,
+)
+from .manifest import RangeManifest, SegmentManifest
 from .models import Job
+from .muxer import (
+    CONCAT,
+    MP4,
+    concat_stream,
+    get_partial_path,
+    iter_progress,
+    mux_stream,
+    replace_output,
+)
+from .playlist import (
+    PlaylistException,
+    get_segments,
+    is_fragmented_mp4,
+    is_playlist_response,
+    resolve_playlist,
+)
+from .ratelimit import get_host_limiter, limit_host
+from .spans import job_span
 
 logger = logging.getLogger(__name__)
 
-USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.121 Safari/537.36"
-
 
 class JobNotPendingException(Exception):
     """Prevent double-handling of job exception"""
 
 
-class FailedToDownloadSegmentException(Exception):
-    """A piece could not be downloaded"""
-
-
-def get_chrome_url():
-    schema, _, hostname, path = settings.CHROME_REMOTE_URL.split("/", 3)
-    hostname, port = hostname.split(":")
-    url = "%s//%s:%s/%s" % (schema, socket.gethostbyname(hostname), port, path)
-
-    r = requests.get(url).json()
-    return r["webSocketDebuggerUrl"]
-
-
 def sanitize_title(title):
     keepcharacters = (" ", ".", "_")
     return "".join(c for c in title if c.isalnum() or c in keepcharacters).strip()[-50:]
 
 
-async def execute_job(extractor_cls, chrome_url, job):
-    logger.info("Initiating browser for job execution")
-    browser = await connect({"browserWSEndpoint": chrome_url})
+async def execute_job(extractor_cls, job):
+    if not extractor_cls.requires_browser:
+        with job_span(job, "extract"):
+            return await extractor_cls(job, None).extract()
 
-    page = await browser.newPage()
-    await page.setUserAgent(USER_AGENT)
-    await page.setViewport({"width": 1024, "height": 768})
+    logger.info("Getting browser page for job execution")
+    browser_pool = get_browser_pool()
+    with job_span(job, "browser"):
+        page = await browser_pool.acquire()
+    browser = browser_pool.browser
     extractor = extractor_cls(job, page)
 
     def on_restart_required():
-        extractor.cancelled = True
+        extractor.cancel()
 
     browser.on("disconnected", on_restart_required)
     page.on("close", on_restart_required)
 
-    result = await extractor.extract()
-
-    logger.info("Cleaning up browser")
-    await page.close()
-    await browser.disconnect()
+    suspended = False
+    try:
+        with job_span(job, "extract", ok_exceptions=(SuspendExtraction,)):
+            await extractor.setup_request_interception()
+            result = await extractor.extract()
+    except SuspendExtraction as e:
+        logger.info("Suspending job, leaving page open in browser")
+        suspended = True
+        job.suspended_state = json.dumps(
+            {
+                "extractor": extractor.name,
+                "target_id": await browser_pool.detach(page),
+                "state": e.state,
+            }
+        )
+        job.save()
+        raise
+    finally:
+        browser.remove_listener("disconnected", on_restart_required)
+        if not suspended:
+            logger.info("Returning page to browser pool")
+            await browser_pool.release(page)
 
     return result
 
 
-def duration_to_number(duration):
-    duration_time, partial_seconds = duration.split(".")
-    hours, minutes, seconds = duration_time.split(":")
-    total = int(hours) * 60
-    total += int(minutes)
-    total *= 60
-    total += int(seconds)
-    return total
+def report_progress_to(job, total=None, offset=0):
+    async def report_progress(batch_total, progress, **kwargs):
+        job.send_progress_update(total or batch_total, offset + progress, **kwargs)
+
+    return report_progress
+
+
+def create_downloader(headers, progress_callback, stats=None):
+    return SegmentDownloader(
+        headers,
+        settings.DOWNLOAD_CONCURRENCY,
+        progress_callback,
+        settings.DOWNLOAD_CONCURRENCY_MAX,
+        get_host_limiter(),
+        connect_timeout=settings.DOWNLOAD_CONNECT_TIMEOUT,
+        read_timeout=settings.DOWNLOAD_READ_TIMEOUT,
+        min_throughput=settings.DOWNLOAD_MIN_THROUGHPUT,
+        hedge_factor=settings.DOWNLOAD_HEDGE_FACTOR,
+        stats=stats,
+    )
+
+
+def get_request_timeout():
+    """Connect and read timeouts for requests outside the segment downloader"""
+    return (settings.DOWNLOAD_CONNECT_TIMEOUT, settings.DOWNLOAD_READ_TIMEOUT)
+
+
+def get_scratch_path(job):
+    return os.path.join(settings.MEDIA_ROOT, str(job.pk), ".partial")
+
+
+def download_segments(job, segments, headers, stats=None):
+    """
+    Download all segments to the job scratch directory, segments downloaded
+    by an earlier attempt are kept and not downloaded again.
+    """
+    with SegmentManifest(get_scratch_path(job)) as manifest:
+        missing = [
+            i
+            for i, segment in enumerate(segments)
+            if not manifest.is_complete(i, segment.uri)
+        ]
+
+        total = len(segments)
+        logger.debug(
+            "Queuing up %s segments, %s already downloaded"
+            % (len(missing), total - len(missing))
+        )
+
+        def on_complete(position, size):
+            i = missing[position]
+            manifest.mark_complete(i, segments[i].uri, size)
+
+        async def download():
+            async with create_downloader(
+                headers, report_progress_to(job, total, total - len(missing)), stats
+            ) as downloader:
+                return await downloader.download(
+                    (
+                        (segments[i].uri, segments[i].byterange, manifest.target(i))
+                        for i in missing
+                    ),
+                    on_complete,
+                    len(missing),
+                )
+
+        asyncio.get_event_loop().run_until_complete(download())
 
 
-def download_file_segment(url, target, headers):
+def preallocate(fd, size):
+    if os.fstat(fd).st_size == size:
+        return
+
+    os.ftruncate(fd, size)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        pass
+
+
+def download_ranges(job, url, size, headers, target_path, stats=None):
+    """
+    Download a file as parallel byte ranges written into a preallocated file,
+    ranges downloaded by an earlier attempt are kept and not downloaded again.
+    """
+    scratch_path = get_scratch_path(job)
+    partial_path = os.path.join(scratch_path, "download")
+    range_size = settings.DOWNLOAD_RANGE_SIZE
+    ranges = [
+        (offset, min(range_size, size - offset))
+        for offset in range(0, size, range_size)
+    ]
+
+    with RangeManifest(scratch_path, size) as manifest:
+        missing = [r for r in ranges if not manifest.is_complete(r, url)]
+        if not os.path.isfile(partial_path):
+            missing = ranges
+
+        total = len(ranges)
+        logger.debug(
+            "Downloading %s ranges, %s already downloaded"
+            % (len(missing), total - len(missing))
+        )
+
+        def on_complete(position, length):
+            manifest.mark_complete(missing[position], url, length)
+
+        fd = os.open(partial_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            preallocate(fd, size)
+
+            async def download():
+                async with create_downloader(
+                    headers, report_progress_to(job, total, total - len(missing)), stats
+                ) as downloader:
+                    return await downloader.download_ranges(
+                        url, fd, missing, on_complete
+                    )
+
+            asyncio.get_event_loop().run_until_complete(download())
+        finally:
+            os.close(fd)
+
+    os.replace(partial_path, target_path)
+    shutil.rmtree(scratch_path)
+
+
+def download_file(job, url, headers, target_path, stats=None):
+    """
+    Download a file with a single connection when the server does not support
+    ranges, the connection is held from the host limiter until it is done.
+    """
+    partial_path = target_path + ".partial"
+    progress = 0
+    try:
+        with limit_host(url), requests.get(
+            url, headers=headers, stream=True, timeout=get_request_timeout()
+        ) as r:
+            r.raise_for_status()
+            size = int(r.headers.get("Content-Length") or 0)
+            with open(partial_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                    progress += len(chunk)
+                    if stats is not None:
+                        stats["bytes"] = progress
+                    if size:
+                        job.send_progress_update(size, progress)
+    except requests.RequestException:
+        raise FailedToDownloadSegmentException("Failed while downloading file")
+
+    os.replace(partial_path, target_path)
+
+
+def download_direct(job, r, headers, target_path, stats=None):
+    """
+    Download a media file that is not a playlist, no muxing is needed.
+    r is the closed response from fetch_playlist.
+    """
+    size = int(r.headers.get("Content-Length") or 0)
+    if size and r.headers.get("Accept-Ranges") == "bytes":
+        download_ranges(job, r.url, size, headers, target_path, stats)
+    else:
+        logger.info("Server does not support ranges, using a single connection")
+        download_file(job, r.url, headers, target_path, stats)
+
+
+def feed_files(p, paths):
+    """
+    Write files one after another into the stdin of process p, the same bytes
+    ffmpeg's concat protocol would read. p is killed if a file cannot be read.
+    """
+    try:
+        for path in paths:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, p.stdin, 1024 * 1024)
+    except BrokenPipeError:
+        logger.warning("ffmpeg stopped reading from stdin")
+    except OSError:
+        logger.exception("Failed to read segment, stopping ffmpeg")
+        p.kill()
+    finally:
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def mux_files(segments, target_full_path, duration=None, progress_callback=None):
+    """
+    Merge an iterable of downloaded segment paths with ffmpeg, returns ffmpeg's
+    returncode. The segments are piped into ffmpeg so the command line does not
+    grow with the playlist. Progress is reported to progress_callback against
+    duration in seconds, when it is known.
+    """
+    cmd = ["ffmpeg"]
+    cmd += [
+        "-y",
+        "-nostats",
+        "-loglevel",
+        "error",
+        "-progress",
+        "pipe:1",
+        "-i",
+        "pipe:0",
+        "-c",
+        "copy",
+        "-f",
+        "mp4",
+        get_partial_path(target_full_path),
+    ]
+
+    logger.debug("Merging result with ffmpeg")
+
+    with tempfile.TemporaryFile() as stderr:
+        p = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr
+        )
+        feeder = threading.Thread(target=feed_files, args=(p, segments), daemon=True)
+        feeder.start()
+        for progress in iter_progress(p.stdout):
+            if not duration or not progress_callback:
+                continue
+
+            if progress["done"]:
+                position = duration
+            else:
+                position = min(progress["time"] or 0, duration)
+            progress_callback(
+                duration, position, speed=progress["speed"], bitrate=progress["bitrate"]
+            )
+
+        returncode = p.wait()
+        feeder.join()
+        replace_output(target_full_path, not returncode)
+        if returncode:
+            stderr.seek(0)
+            logger.warning(
+                "ffmpeg failed with returncode %s: %s"
+                % (returncode, stderr.read().decode("utf-8", "replace"))
+            )
+    return returncode
+
+
+def download_and_concat(job, segments, headers, target_full_path, stats=None):
+    """Write segments in order straight into the output file without ffmpeg"""
+    logger.debug("Concatenating %s segments" % (len(segments),))
+    ranges = ((segment.uri, segment.byterange) for segment in segments)
+
+    async def stream_segments():
+        async with create_downloader(
+            headers, report_progress_to(job), stats
+        ) as downloader:
+            return await concat_stream(
+                downloader.iter_segments(
+                    ranges, settings.STREAM_BUFFER_SEGMENTS, len(segments)
+                ),
+                target_full_path,
+            )
+
+    return asyncio.get_event_loop().run_until_complete(stream_segments())
+
+
+def download_and_mux_stream(job, segments, headers, target_full_path, stats=None):
+    """Feed segments to ffmpeg in order while the rest are still downloading"""
+    logger.debug("Streaming %s segments into ffmpeg" % (len(segments),))
+    ranges = ((segment.uri, segment.byterange) for segment in segments)
+
+    async def stream_segments():
+        async with create_downloader(
+            headers, report_progress_to(job), stats
+        ) as downloader:
+            return await mux_stream(
+                downloader.iter_segments(
+                    ranges, settings.STREAM_BUFFER_SEGMENTS, len(segments)
+                ),
+                target_full_path,
+            )
+
+    return asyncio.get_event_loop().run_until_complete(stream_segments())
+
+
+def finish_job(job, returncode):
+    if returncode:
+        job.status_message = "Failed FFMpeg with returncode %s" % (returncode,)
+        job.status = job.FAILED
+    else:
+        job.path = os.path.join(str(job.pk), job.name)
+        job.status_message = "Finished"
+        job.status = job.SUCCESS
+    job.save()
+
+
+def run_extractor(job, extractor_cls):
+    """Find the media with the browser, returns None if the job cannot continue"""
+    job.suspended_state = ""
+    job.status = job.PARSING
+    job.status_message = "Extracting video using %s" % (extractor_cls.name,)
+    job.save()
+
     for i in range(3):
-        logger.debug("Starting to download %s attempt %s" % (url, i))
         try:
-            with requests.get(url, stream=True, headers=headers) as r:
-                with open(target, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-        except requests.exceptions.RequestException:
-            logger.warning("Failed to download url %s" % (url,))
-            continue
-        return
-    raise FailedToDownloadSegmentException()
+            return asyncio.get_event_loop().run_until_complete(
+                execute_job(extractor_cls, job)
+            )
+        except SuspendExtraction:
+            logger.info("Job %s suspended while waiting for user input" % (job.pk,))
+            return
+        except JobFailedException as e:
+            job.status_message = str(e)
+            job.status = job.FAILED
+            job.save()
+
+            return
+        except BrowserUnavailableException:
+            logger.exception("Failed to get chrome URL")
+
+            job.status_message = "Failed to get chrome URL"
+            job.status = job.FAILED
+            job.save()
+
+            return
+        except (
+            errors.PyppeteerError,
+            asyncio.TimeoutError,
+            ExtractionCancelledException,
+        ):
+            logger.exception("Pyppeteer failed, attempt %s of 3" % (i + 1))
+            time.sleep(5)
+
+    job.status_message = "Failed to get puppeteer to get url"
+    job.status = job.FAILED
+    job.save()
+
+
+def get_request_headers(result):
+    headers = {"User-Agent": USER_AGENT}
+    headers.update(result["headers"])
+    return headers
+
+
+def fetch_playlist(url, headers):
+    """
+    Fetch a playlist while holding a connection from the host limiter. The body
+    is only read if the response is a playlist, a media file is closed after
+    its headers and downloaded separately.
+    """
+    logger.debug("Fetching m3u8 %s" % (url,))
+    with limit_host(url):
+        r = requests.get(
+            url, headers=headers, stream=True, timeout=get_request_timeout()
+        )
+        with r:
+            if r.ok and is_playlist_response(r):
+                # Read the body before the connection is given back
+                r.content
+    return r
 
 
 @shared_task
-def handle_job(job_id):
+def handle_job(job_id, result=None, use_cache=True):
+    """
+    First stage of a job, find the media and pass it on to the download stage.
+    If result is passed, e.g. when resuming a suspended job, the extraction
+    is skipped.
+    """
     logger.info("Trying to handle job %s" % (job_id,))
     job = Job.objects.get(pk=job_id)
     if job.status != Job.PENDING:
@@ -114,131 +486,192 @@ def handle_job(job_id):
         job.save()
         return
 
-    job.status = job.PARSING
-    job.status_message = "Extracting video using %s" % (extractor_cls.name,)
-    job.save()
+    if job.extractor != extractor_cls.name:
+        job.extractor = extractor_cls.name
+        Job.objects.filter(pk=job.pk).update(extractor=job.extractor)
 
-    for i in range(3):
-        try:
-            chrome_url = get_chrome_url()
-        except:
-            logger.exception("Failed to get chrome URL")
+    from_cache = False
+    if result is None and use_cache and extractor_cls.cache_ttl:
+        result = extraction_cache.get(job.url)
+        from_cache = result is not None
 
-            job.status_message = "Failed to get chrome URL"
+    if result is None:
+        result = run_extractor(job, extractor_cls)
+        if result is None:
+            return
+
+    if not from_cache and extractor_cls.cache_ttl:
+        extraction_cache.set(job.url, result, extractor_cls.cache_ttl)
+
+    output_format = job.output_format or extractor_cls.output_format
+    download_job.delay(job_id, result, from_cache, output_format)
+
+
+def fail_job_on_error(func):
+    """Mark the job of a task as failed when the task raises unexpectedly"""
+
+    @functools.wraps(func)
+    def wrapper(job_id, *args, **kwargs):
+        try:
+            return func(job_id, *args, **kwargs)
+        except Exception as e:
+            logger.exception("Job %s failed unexpectedly" % (job_id,))
+            job = Job.objects.get(pk=job_id)
             job.status = job.FAILED
+            job.status_message = "Unexpected error: %s" % (e,)
             job.save()
 
+    return wrapper
+
+
+@shared_task
+@fail_job_on_error
+def download_job(job_id, result, from_cache=False, output_format=MP4):
+    """
+    Second stage of a job, download the segments of the playlist. A media file
+    that is not a playlist is downloaded directly and finishes the job, as do
+    playlists with the concat output format.
+    """
+    job = Job.objects.get(pk=job_id)
+    if job.status == job.CANCELLED:
+        return
+
+    headers = get_request_headers(result)
+    playlist = None
+    try:
+        with job_span(job, "playlist"):
+            r = fetch_playlist(result["url"], headers)
+            r.raise_for_status()
+            if is_playlist_response(r):
+                playlist, playlist_url = resolve_playlist(
+                    lambda url: fetch_playlist(url, headers), r, job
+                )
+    except requests.HTTPError as e:
+        if from_cache and e.response.status_code in (403, 404):
+            logger.info("Cached extraction result is no longer valid, extracting again")
+            extraction_cache.invalidate(job.url)
+            job.status = job.PENDING
+            job.save()
+            handle_job.delay(job_id, use_cache=False)
             return
 
-        try:
-            result = asyncio.get_event_loop().run_until_complete(
-                execute_job(extractor_cls, chrome_url, job)
-            )
-        except (errors.PyppeteerError, asyncio.TimeoutError):
-            logger.exception("Pyppeteer failed, attempt %s of 3" % (i + 1))
-            time.sleep(5)
-        else:
-            break
-    else:
-        job.status_message = "Failed to get puppeteer to get url"
+        logger.exception("Failed to fetch playlist")
         job.status = job.FAILED
+        job.status_message = "Failed to fetch playlist: %s" % (e,)
         job.save()
+        return
+    except requests.RequestException as e:
+        logger.exception("Failed to fetch playlist")
+        job.status = job.FAILED
+        job.status_message = "Failed to fetch playlist: %s" % (e,)
+        job.save()
+        return
+    except PlaylistException as e:
+        job.status = job.FAILED
+        job.status_message = str(e)
+        job.save()
+        return
 
+    media_url = r.url if playlist is None else playlist_url
+    variant = get_variant_key(media_url, output_format)
+    if not claim_media(job, job.extractor, result["id"], variant):
         return
 
-    media_path = str(job.pk)
-    target_path = os.path.join(settings.MEDIA_ROOT, media_path)
+    target_path = os.path.join(settings.MEDIA_ROOT, str(job.pk))
     if not os.path.isdir(target_path):
         os.makedirs(target_path)
 
-    logger.debug("Fetching m3u8")
-    headers = {"User-Agent": USER_AGENT}
-    headers.update(result["headers"])
-    r = requests.get(result["url"], headers=headers)
-    playlist = m3u8.loads(r.text)
-
-    target_filename = "%s - %s.mp4" % (sanitize_title(result["title"]), result["id"])
+    extension = "mp4"
+    if (
+        playlist is not None
+        and output_format == CONCAT
+        and not is_fragmented_mp4(playlist)
+    ):
+        extension = "ts"
+
+    target_filename = "%s - %s.%s" % (
+        sanitize_title(result["title"]),
+        result["id"],
+        extension,
+    )
     target_full_path = os.path.join(target_path, target_filename)
 
     job.name = target_filename
     job.status = job.DOWNLOADING
-    job.status_message = f"Downloading {len(playlist.segments)} segments"
+
+    if playlist is None:
+        job.status_message = "Downloading file"
+        job.save()
+        try:
+            with job_span(job, "download") as stats:
+                download_direct(job, r, headers, target_full_path, stats)
+        except FailedToDownloadSegmentException as e:
+            logger.exception("Failed to download")
+            job.status = job.FAILED
+            job.status_message = str(e)
+            job.save()
+            return
+        finish_job(job, 0)
+        return
+
+    segments = get_segments(playlist, playlist_url)
+    job.status_message = f"Downloading {len(segments)} segments"
     job.save()
 
-    logger.debug("Queuing up %s segments" % (len(playlist.segments),))
-    with tempfile.TemporaryDirectory() as download_dir:
-        segments = []
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=settings.DOWNLOAD_CONCURRENCY
-        ) as executor:
-            futures = []
-            for i, segment in enumerate(playlist.segments):
-                target = os.path.join(download_dir, f"{i:05}.ts")
-                segments.append(target)
-                futures.append(
-                    (
-                        executor.submit(
-                            download_file_segment, segment.uri, target, headers
-                        )
-                    )
+    try:
+        if output_format == CONCAT:
+            with job_span(job, "download") as stats:
+                download_and_concat(job, segments, headers, target_full_path, stats)
+            finish_job(job, 0)
+            return
+
+        if settings.STREAMING_MUX:
+            with job_span(job, "stream") as stats:
+                returncode = download_and_mux_stream(
+                    job, segments, headers, target_full_path, stats
                 )
+            finish_job(job, returncode)
+            return
 
-            for i, future in enumerate(futures, 1):
-                try:
-                    future.result()
-                except Exception:
-                    logger.exception("Failed to download")
-                    job.status = job.FAILED
-                    job.status_message = f"Failed while downloading segment {i}"
-                    job.save()
-                    return
-                else:
-                    job.send_progress_update(total=len(playlist.segments), progress=i)
-
-        job.status_message = f"Finished downloading {len(playlist.segments)} segments, merging with ffmpeg"
+        with job_span(job, "download") as stats:
+            download_segments(job, segments, headers, stats)
+    except FailedToDownloadSegmentException as e:
+        logger.exception("Failed to download")
+        job.status = job.FAILED
+        job.status_message = str(e)
         job.save()
+        return
 
-        cmd = ["ffmpeg"]
-        cmd += [
-            "-y",
-            "-i",
-            f"concat:{'|'.join(segments)}",
-            "-c",
-            "copy",
-            "-f",
-            "mp4",
-            target_full_path,
-        ]
-
-        logger.debug("Merging result with ffmpeg")
-
-        p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    job.status_message = (
+        f"Finished downloading {len(segments)} segments, merging with ffmpeg"
+    )
+    job.save()
 
-        duration, progress = None, None
+    duration = sum(segment.duration or 0 for segment in segments)
+    mux_job.delay(job_id, len(segments), duration)
 
-        for line in p.stderr:
-            line = line.decode("utf-8")
-            if not duration:
-                duration_result = re.findall(
-                    r"Duration: (\d{2}:\d{2}:\d{2}\.\d{2})", line
-                )
-                if duration_result:
-                    duration = duration_to_number(duration_result[0])
 
-            progress_result = re.findall(r"time=(\d{2}:\d{2}:\d{2}\.\d{2})", line)
-            if progress_result:
-                progress = duration_to_number(progress_result[0])
+@shared_task
+@fail_job_on_error
+def mux_job(job_id, segment_count, duration=None):
+    """
+    Last stage of a job, merge the downloaded segments. duration is the
+    length of the playlist in seconds.
+    """
+    job = Job.objects.get(pk=job_id)
+    if job.status == job.CANCELLED:
+        return
 
-            if duration is not None and progress is not None:
-                job.send_progress_update(duration, progress)
+    scratch_path = get_scratch_path(job)
+    with SegmentManifest(scratch_path) as manifest:
+        segments = (manifest.target(i) for i in range(segment_count))
 
-        returncode = p.wait()
+    target_full_path = os.path.join(settings.MEDIA_ROOT, str(job.pk), job.name)
+    with job_span(job, "mux"):
+        returncode = mux_files(
+            segments, target_full_path, duration, job.send_progress_update
+        )
+    if not returncode:
+        shutil.rmtree(scratch_path)
 
-        if returncode:
-            job.status_message = "Failed FFMpeg with returncode %s" % (returncode,)
-            job.status = job.FAILED
-        else:
-            job.path = os.path.join(media_path, target_filename)
-            job.status_message = "Finished"
-            job.status = job.SUCCESS
-        job.save()
+    finish_job(job, returncode)
@@ -1,3 +1,997 @@
-from django.test import TestCase
+import asyncio
+import os
+import re
+import shutil
+import tempfile
 
-# Create your tests here.
+from datetime import timedelta
+from unittest import mock
+
+import m3u8
+import requests
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .dedup import claim_media, get_variant_key
+from .downloader import (
+    AdaptiveLimiter,
+    FailedToDownloadSegmentException,
+    ReorderBuffer,
+    SegmentDownloader,
+    SegmentStalledException,
+)
+from .events import EventPublisher
+from .extractors._base import JobFailedException
+from .manifest import SegmentManifest
+from .models import Job, Media, remove_job_scratch
+from .muxer import MP4, concat_stream, iter_progress
+from .playlist import (
+    HIGHEST,
+    LOWEST,
+    MAX_BANDWIDTH,
+    MAX_RESOLUTION,
+    Segment,
+    get_segments,
+    parse_byterange,
+    select_variant,
+)
+from .ratelimit import LocalHostLimiter
+from .tasks import (
+    download_job,
+    download_ranges,
+    download_segments,
+    get_scratch_path,
+    handle_job,
+)
+
+
+class AsyncTestCase(SimpleTestCase):
+    """Runs coroutines on a new event loop for every test"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class ReorderBufferTestCase(AsyncTestCase):
+    def test_yields_in_order(self):
+        async def test():
+            buffer = ReorderBuffer(3)
+            await buffer.put(2, b"c")
+            await buffer.put(0, b"a")
+            await buffer.put(1, b"b")
+            return [await buffer.get() for _ in range(3)]
+
+        self.assertEqual(self.run_async(test()), [b"a", b"b", b"c"])
+
+    def test_reserve_waits_for_room(self):
+        async def test():
+            buffer = ReorderBuffer(2)
+            await buffer.reserve(1)
+            reserve = asyncio.ensure_future(buffer.reserve(2))
+            await asyncio.sleep(0.01)
+            waited = not reserve.done()
+
+            await buffer.put(0, b"a")
+            await buffer.get()
+            await asyncio.wait_for(reserve, 1)
+            return waited
+
+        self.assertTrue(self.run_async(test()))
+
+    def test_fail_raises_in_get(self):
+        async def test():
+            buffer = ReorderBuffer(2)
+            await buffer.fail(ValueError("failed"))
+            await buffer.get()
+
+        with self.assertRaises(ValueError):
+            self.run_async(test())
+
+
+class TemporaryMediaMixin:
+    """Points MEDIA_ROOT to a temporary directory removed after the test"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+
+class OriginTestCase(TemporaryMediaMixin, AsyncTestCase):
+    """
+    Serves `files` from a local HTTP server with support for single byte ranges.
+    Requests are recorded as (name, range) and names or ranges in `failing`
+    get a 500 response.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.files = {}
+        self.failing = set()
+        self.requests = []
+        app = web.Application()
+        app.router.add_get("/{name}", self.serve)
+        self.server = TestServer(app)
+        self.run_async(self.server.start_server())
+
+    def tearDown(self):
+        self.run_async(self.server.close())
+        super().tearDown()
+
+    def url(self, name):
+        return str(self.server.make_url("/" + name))
+
+    async def serve(self, request):
+        name = request.match_info["name"]
+        byterange = request.headers.get("Range")
+        self.requests.append((name, byterange))
+        if name in self.failing or byterange in self.failing:
+            return web.Response(status=500)
+
+        data = self.files[name]
+        if not byterange:
+            return web.Response(body=data)
+        start, _, end = byterange[len("bytes=") :].partition("-")
+        return web.Response(status=206, body=data[int(start) : int(end) + 1])
+
+
+class SegmentManifestTestCase(TemporaryMediaMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.media_root, "scratch")
+
+    def write_segment(self, manifest, index, data):
+        with open(manifest.target(index), "wb") as f:
+            f.write(data)
+
+    def test_complete_segments_survive_reopening(self):
+        with SegmentManifest(self.path) as manifest:
+            self.write_segment(manifest, 0, b"abc")
+            manifest.mark_complete(0, "http://cdn1.example.com/a/0.ts?sig=1", 3)
+
+        with SegmentManifest(self.path) as manifest:
+            self.assertTrue(
+                manifest.is_complete(0, "http://cdn2.example.com/a/0.ts?sig=2")
+            )
+            self.assertFalse(manifest.is_complete(0, "http://example.com/b/0.ts"))
+            self.assertFalse(manifest.is_complete(1, "http://example.com/a/0.ts"))
+
+    def test_partial_or_missing_segments_are_not_complete(self):
+        with SegmentManifest(self.path) as manifest:
+            self.write_segment(manifest, 0, b"abc")
+            manifest.mark_complete(0, "http://example.com/0.ts", 3)
+            self.write_segment(manifest, 1, b"abc")
+            manifest.mark_complete(1, "http://example.com/1.ts", 3)
+
+            self.write_segment(manifest, 0, b"ab")
+            os.remove(manifest.target(1))
+            self.assertFalse(manifest.is_complete(0, "http://example.com/0.ts"))
+            self.assertFalse(manifest.is_complete(1, "http://example.com/1.ts"))
+
+    def test_skips_broken_lines(self):
+        with SegmentManifest(self.path) as manifest:
+            self.write_segment(manifest, 0, b"abc")
+            manifest.mark_complete(0, "http://example.com/0.ts", 3)
+            manifest.f.write('{"key": "1:/1.ts", "si\n')
+
+        with SegmentManifest(self.path) as manifest:
+            self.assertTrue(manifest.is_complete(0, "http://example.com/0.ts"))
+            self.assertEqual(len(manifest.segments), 1)
+
+
+@override_settings(
+    DOWNLOAD_CONCURRENCY=1,
+    DOWNLOAD_CONCURRENCY_MAX=1,
+    DOWNLOAD_HEDGE_FACTOR=0,
+    HOST_RATE=0,
+    HOST_CONNECTIONS=0,
+)
+class DownloadSegmentsTestCase(OriginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.job = mock.Mock(pk=1)
+        for i in range(4):
+            self.files["%s.ts" % (i,)] = ("segment %s" % (i,)).encode()
+        self.segments = [Segment(self.url("%s.ts" % (i,))) for i in range(4)]
+
+    def get_requested(self):
+        requested = [name for name, _ in self.requests]
+        self.requests = []
+        return requested
+
+    def test_resumes_missing_and_partial_segments(self):
+        self.failing.add("2.ts")
+        with self.assertRaises(FailedToDownloadSegmentException):
+            download_segments(self.job, self.segments, {})
+        self.assertEqual(self.get_requested(), ["0.ts", "1.ts"] + ["2.ts"] * 3)
+
+        with open(os.path.join(get_scratch_path(self.job), "00001.ts"), "wb") as f:
+            f.write(b"seg")
+
+        self.failing.clear()
+        download_segments(self.job, self.segments, {})
+        self.assertEqual(self.get_requested(), ["1.ts", "2.ts", "3.ts"])
+
+        with SegmentManifest(get_scratch_path(self.job)) as manifest:
+            for i in range(4):
+                with open(manifest.target(i), "rb") as f:
+                    self.assertEqual(f.read(), self.files["%s.ts" % (i,)])
+
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+@mock.patch("rippy.tasks.handle_job")
+class JobScratchTestCase(TemporaryMediaMixin, TestCase):
+    def test_only_cancelled_jobs_remove_scratch(self, handle_job):
+        job = Job.objects.create(url="http://example.com/1", scheduled=True)
+        os.makedirs(get_scratch_path(job))
+
+        job.status = Job.FAILED
+        job.save()
+        self.assertTrue(os.path.exists(get_scratch_path(job)))
+
+        job.status = Job.CANCELLED
+        job.save()
+        self.assertFalse(os.path.exists(get_scratch_path(job)))
+
+
+class StubExtractor:
+    name = "stub"
+    matcher = re.compile(r"^http://example\.com/")
+    cache_ttl = 60
+    output_format = MP4
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+@mock.patch("rippy.tasks.EXTRACTORS", [StubExtractor])
+@mock.patch("rippy.tasks.extraction_cache")
+class ExtractionCacheTestCase(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.job = Job.objects.create(url="http://example.com/video", scheduled=True)
+        self.result = {
+            "url": "http://cdn.example.com/index.m3u8",
+            "title": "Video",
+            "id": "1",
+            "headers": {},
+        }
+
+    def get_response(self, status_code):
+        r = requests.Response()
+        r.status_code = status_code
+        r.url = self.result["url"]
+        r.encoding = "utf-8"
+        return r
+
+    @mock.patch("rippy.tasks.download_job")
+    @mock.patch("rippy.tasks.run_extractor")
+    def test_cached_result_skips_extraction(self, run_extractor, download_job, cache):
+        cache.get.return_value = self.result
+        handle_job(self.job.pk)
+
+        cache.get.assert_called_once_with(self.job.url)
+        run_extractor.assert_not_called()
+        cache.set.assert_not_called()
+        download_job.delay.assert_called_once_with(self.job.pk, self.result, True, MP4)
+
+    @mock.patch("rippy.tasks.download_job")
+    @mock.patch("rippy.tasks.run_extractor")
+    def test_extracted_result_is_cached(self, run_extractor, download_job, cache):
+        run_extractor.return_value = self.result
+        handle_job(self.job.pk, use_cache=False)
+
+        cache.get.assert_not_called()
+        cache.set.assert_called_once_with(self.job.url, self.result, 60)
+        download_job.delay.assert_called_once_with(self.job.pk, self.result, False, MP4)
+
+    @mock.patch("rippy.tasks.download_job")
+    @mock.patch("rippy.tasks.execute_job")
+    def test_failed_extraction_fails_job(self, execute_job, download_job, cache):
+        execute_job.side_effect = JobFailedException("Failed to find video url")
+        handle_job(self.job.pk, use_cache=False)
+
+        download_job.delay.assert_not_called()
+        cache.set.assert_not_called()
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.FAILED)
+        self.assertEqual(self.job.status_message, "Failed to find video url")
+
+    @mock.patch("rippy.tasks.claim_media")
+    @mock.patch("rippy.tasks.fetch_playlist")
+    def test_claims_media_of_resolved_variant(self, fetch_playlist, claim_media, cache):
+        master = self.get_response(200)
+        master._content = (
+            b"#EXTM3U\n"
+            b"#EXT-X-STREAM-INF:BANDWIDTH=1000\nlow/index.m3u8\n"
+            b"#EXT-X-STREAM-INF:BANDWIDTH=2000\nhigh/index.m3u8\n"
+        )
+        variant = self.get_response(200)
+        variant.url = "http://cdn.example.com/high/index.m3u8?token=1"
+        variant._content = b"#EXTM3U\n#EXTINF:10,\n0.ts\n#EXT-X-ENDLIST\n"
+        fetch_playlist.side_effect = [master, variant]
+        claim_media.return_value = False
+        Job.objects.filter(pk=self.job.pk).update(extractor="stub")
+
+        download_job(self.job.pk, self.result, False)
+
+        claim_media.assert_called_once_with(
+            mock.ANY,
+            "stub",
+            "1",
+            get_variant_key("http://cdn.example.com/high/index.m3u8", MP4),
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.media_root, str(self.job.pk)))
+        )
+
+    @mock.patch("rippy.tasks.handle_job")
+    @mock.patch("rippy.tasks.fetch_playlist")
+    def test_expired_cached_result_is_extracted_again(
+        self, fetch_playlist, handle_job, cache
+    ):
+        fetch_playlist.return_value = self.get_response(403)
+        download_job(self.job.pk, self.result, True)
+
+        cache.invalidate.assert_called_once_with(self.job.url)
+        handle_job.delay.assert_called_once_with(self.job.pk, use_cache=False)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.PENDING)
+
+    @mock.patch("rippy.tasks.handle_job")
+    @mock.patch("rippy.tasks.fetch_playlist")
+    def test_extracted_result_fails(self, fetch_playlist, handle_job, cache):
+        fetch_playlist.return_value = self.get_response(404)
+        download_job(self.job.pk, self.result, False)
+
+        cache.invalidate.assert_not_called()
+        handle_job.delay.assert_not_called()
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.FAILED)
+
+
+class QuietEventPublisher(EventPublisher):
+    """Keeps events pending so the test can take them with get_due_events"""
+
+    def notify(self):
+        pass
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class EventPublisherTestCase(SimpleTestCase):
+    def test_merges_superseded_events(self):
+        publisher = QuietEventPublisher(1)
+        publisher.publish(1, "job.update", status="pending")
+        publisher.publish(1, "job.update", status="parsing")
+        publisher.publish(2, "job.update", status="pending")
+        publisher.publish(1, "job.progress", total=10, progress=1)
+        publisher.publish(1, "job.update", status="downloading")
+
+        due, _ = publisher.get_due_events()
+        self.assertEqual(
+            [(event["id"], event["type"], event.get("status")) for event in due],
+            [
+                (1, "job.update", "parsing"),
+                (1, "job.progress", None),
+                (1, "job.update", "downloading"),
+                (2, "job.update", "pending"),
+            ],
+        )
+        self.assertEqual(publisher.stats["merged"], 1)
+        self.assertEqual(publisher.queue_depth, 0)
+
+    def test_keeps_unmerged_events(self):
+        publisher = QuietEventPublisher(1)
+        publisher.publish(None, "job.add", merge=False, jobs=[1])
+        publisher.publish(None, "job.add", merge=False, jobs=[2])
+
+        due, _ = publisher.get_due_events()
+        self.assertEqual([event["jobs"] for event in due], [[1], [2]])
+
+    def test_throttles_progress(self):
+        publisher = QuietEventPublisher(10)
+        publisher.publish(1, "job.progress", total=10, progress=1)
+        due, next_due = publisher.get_due_events()
+        self.assertEqual(len(due), 1)
+        self.assertIsNone(next_due)
+
+        publisher.publish(1, "job.progress", total=10, progress=2)
+        publisher.publish(1, "job.progress", total=10, progress=3)
+        due, next_due = publisher.get_due_events()
+        self.assertEqual(due, [])
+        self.assertIsNotNone(next_due)
+
+        publisher.last_progress_sent[1] -= 10
+        due, _ = publisher.get_due_events()
+        self.assertEqual([event["progress"] for event in due], [3])
+
+        publisher.publish(1, "job.progress", total=10, progress=4)
+        publisher.publish(1, "job.progress", total=10, progress=10)
+        due, _ = publisher.get_due_events()
+        self.assertEqual([event["progress"] for event in due], [10])
+        self.assertNotIn(1, publisher.last_progress_sent)
+
+    def test_drops_progress_when_full(self):
+        publisher = QuietEventPublisher(10)
+        publisher.max_queue_depth = 2
+        publisher.publish(1, "job.update", status="downloading")
+        publisher.publish(2, "job.update", status="downloading")
+        publisher.publish(1, "job.progress", total=10, progress=1)
+        publisher.publish(1, "job.update", status="success")
+
+        due, _ = publisher.get_due_events()
+        self.assertEqual(
+            [(event["id"], event["status"]) for event in due],
+            [(1, "success"), (2, "downloading")],
+        )
+        self.assertEqual(publisher.stats["dropped"], 1)
+
+    def test_forgets_finished_jobs(self):
+        publisher = QuietEventPublisher(10)
+        publisher.publish(1, "job.progress", total=10, progress=1)
+        publisher.get_due_events()
+        self.assertIn(1, publisher.last_progress_sent)
+
+        publisher.forget(1)
+        self.assertNotIn(1, publisher.last_progress_sent)
+
+        publisher.publish(2, "job.progress", total=10, progress=1)
+        publisher.forget(2)
+        self.assertIn(2, publisher.pending)
+        publisher.get_due_events()
+        self.assertNotIn(2, publisher.last_progress_sent)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+@mock.patch("rippy.models.Job.send_event")
+class JobUpdateEventTestCase(TestCase):
+    def test_update_event_skips_timeline(self, send_event):
+        job = Job.objects.create(url="http://example.com/1", scheduled=True)
+        send_event.reset_mock()
+
+        job.status = Job.DOWNLOADING
+        with self.assertNumQueries(1):
+            job.save()
+
+        (event_type,), data = send_event.call_args
+        self.assertEqual(event_type, "job.update")
+        self.assertEqual(data["status"], Job.DOWNLOADING)
+        self.assertNotIn("timeline", data)
+
+
+class AdaptiveLimiterTestCase(AsyncTestCase):
+    async def run_round(self, limiter, latency=0.1, **kwargs):
+        # Rounds take about a second so throughput only depends on the limit
+        limiter.round_started -= 1
+        for _ in range(limiter.limit):
+            await limiter.acquire()
+        for _ in range(limiter.limit):
+            await limiter.release(1000, latency, **kwargs)
+
+    def test_increases_while_latency_holds(self):
+        async def test():
+            limiter = AdaptiveLimiter(2, 4)
+            for _ in range(5):
+                await self.run_round(limiter)
+            return limiter.limit
+
+        self.assertEqual(self.run_async(test()), 4)
+
+    def test_halves_on_failures(self):
+        async def test():
+            limiter = AdaptiveLimiter(2, 16)
+            limiter.limit = 8
+            await self.run_round(limiter, failed=True)
+            return limiter.limit
+
+        self.assertEqual(self.run_async(test()), 4)
+
+    def test_halves_on_throttling_to_floor(self):
+        async def test():
+            limiter = AdaptiveLimiter(2, 16)
+            limiter.limit = 3
+            await limiter.acquire()
+            await limiter.release(0, 0.1, status=429, failed=True)
+            return limiter.limit
+
+        self.assertEqual(self.run_async(test()), 2)
+
+    def test_keeps_limit_when_latency_grows(self):
+        async def test():
+            limiter = AdaptiveLimiter(2, 16)
+            await self.run_round(limiter, latency=0.1)
+            limit = limiter.limit
+            await self.run_round(limiter, latency=1.0)
+            return limit, limiter.limit
+
+        limit, after = self.run_async(test())
+        self.assertEqual(limit, after)
+
+
+class LocalHostLimiterTestCase(SimpleTestCase):
+    def test_connections(self):
+        limiter = LocalHostLimiter(0, 1, 2)
+        self.assertEqual(limiter.try_acquire("a", "1"), 0)
+        self.assertEqual(limiter.try_acquire("a", "2"), 0)
+        self.assertEqual(limiter.try_acquire("a", "3"), limiter.connection_wait)
+        self.assertEqual(limiter.try_acquire("b", "4"), 0)
+
+        limiter.release("a", "1")
+        self.assertEqual(limiter.try_acquire("a", "3"), 0)
+
+    def test_rate(self):
+        limiter = LocalHostLimiter(2, 2, 0)
+        with mock.patch("rippy.ratelimit.time.time", return_value=100):
+            self.assertEqual(limiter.try_acquire("a", "1"), 0)
+            self.assertEqual(limiter.try_acquire("a", "2"), 0)
+            self.assertAlmostEqual(limiter.try_acquire("a", "3"), 0.5)
+
+        with mock.patch("rippy.ratelimit.time.time", return_value=100.5):
+            self.assertEqual(limiter.try_acquire("a", "3"), 0)
+
+    def test_leases_expire(self):
+        limiter = LocalHostLimiter(0, 1, 1)
+        with mock.patch("rippy.ratelimit.time.time", return_value=100):
+            self.assertEqual(limiter.try_acquire("a", "1"), 0)
+            self.assertEqual(limiter.try_acquire("a", "2"), limiter.connection_wait)
+
+        expired = 100 + limiter.lease_ttl
+        with mock.patch("rippy.ratelimit.time.time", return_value=expired):
+            self.assertEqual(limiter.try_acquire("a", "2"), 0)
+
+
+class FetchSegmentTestCase(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.cancelled = []
+        self.host_wait = 0
+
+    def create_downloader(self, *responses, samples=5):
+        """
+        Requests are answered in order by responses, a number of seconds to
+        wait before returning data or an exception to raise.
+        """
+        downloader = SegmentDownloader({}, 2, hedge_factor=2)
+        downloader.hedge_min_delay = 0.05
+        downloader.hedge_check_interval = 0.01
+        downloader.latencies.extend([0.01] * samples)
+        responses = list(responses)
+
+        async def stream(url, byterange, timing):
+            response = responses[len(self.calls)]
+            self.calls.append(url)
+            await asyncio.sleep(self.host_wait)
+            timing["started"] = self.loop.time()
+            if isinstance(response, Exception):
+                raise response
+            try:
+                await asyncio.sleep(response)
+            except asyncio.CancelledError:
+                self.cancelled.append(url)
+                raise
+            return b"data"
+
+        downloader._stream = stream
+        return downloader
+
+    def test_hedges_slow_request(self):
+        downloader = self.create_downloader(10, 0)
+        started = self.loop.time()
+        data = self.run_async(downloader.fetch_segment("http://example.com/1.ts"))
+
+        self.assertEqual(data, b"data")
+        self.assertLess(self.loop.time() - started, 5)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.cancelled, ["http://example.com/1.ts"])
+        self.assertEqual(downloader.stats["hedged"], 1)
+        self.assertEqual(downloader.stats["hedges_won"], 1)
+
+    def test_needs_samples_to_hedge(self):
+        downloader = self.create_downloader(0.2, samples=0)
+        self.run_async(downloader.fetch_segment("http://example.com/1.ts"))
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(downloader.stats["hedged"], 0)
+
+    def test_retries_stalled_request(self):
+        downloader = self.create_downloader(SegmentStalledException(), 0)
+        data = self.run_async(downloader.fetch_segment("http://example.com/1.ts"))
+
+        self.assertEqual(data, b"data")
+        self.assertEqual(downloader.stats["stalled"], 1)
+        self.assertEqual(downloader.stats["retries"], 1)
+        self.assertEqual(downloader.stats["hedged"], 0)
+
+    def test_host_limiter_wait_is_not_hedged(self):
+        downloader = self.create_downloader(0)
+        self.host_wait = 0.2
+        self.run_async(downloader.fetch_segment("http://example.com/1.ts"))
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(downloader.stats["hedged"], 0)
+
+
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360
+360.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2800000,RESOLUTION=1280x720
+720.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=5000000,RESOLUTION=1920x1080
+1080.m3u8
+"""
+
+BYTERANGE_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:4
+#EXT-X-TARGETDURATION:10
+#EXTINF:10.0,
+#EXT-X-BYTERANGE:1000@0
+media.ts
+#EXTINF:10.0,
+#EXT-X-BYTERANGE:2000
+media.ts
+#EXTINF:5.0,
+segments/last.ts
+#EXT-X-ENDLIST
+"""
+
+
+class PlaylistTestCase(SimpleTestCase):
+    def test_parse_byterange(self):
+        range_ends = {}
+        self.assertEqual(parse_byterange("1000@0", range_ends, "a"), (0, 1000))
+        self.assertEqual(parse_byterange("500", range_ends, "a"), (1000, 500))
+        self.assertEqual(parse_byterange("500", range_ends, "b"), (0, 500))
+
+    def test_get_segments(self):
+        playlist = m3u8.loads(BYTERANGE_PLAYLIST)
+        segments = get_segments(playlist, "http://example.com/video/index.m3u8")
+
+        self.assertEqual(
+            [(s.uri, s.byterange, s.duration) for s in segments],
+            [
+                ("http://example.com/video/media.ts", (0, 1000), 10.0),
+                ("http://example.com/video/media.ts", (1000, 2000), 10.0),
+                ("http://example.com/video/segments/last.ts", None, 5.0),
+            ],
+        )
+
+    def test_select_variant(self):
+        variants = m3u8.loads(MASTER_PLAYLIST).playlists
+
+        def select(*args):
+            return select_variant(variants, *args).uri
+
+        self.assertEqual(select(HIGHEST), "1080.m3u8")
+        self.assertEqual(select(LOWEST), "360.m3u8")
+        self.assertEqual(select(MAX_BANDWIDTH, 3000000), "720.m3u8")
+        self.assertEqual(select(MAX_BANDWIDTH, 100), "360.m3u8")
+        self.assertEqual(select(MAX_RESOLUTION, None, 720), "720.m3u8")
+        self.assertEqual(select(MAX_RESOLUTION, None, 240), "360.m3u8")
+        self.assertEqual(select(MAX_RESOLUTION), "1080.m3u8")
+
+
+@override_settings(
+    DOWNLOAD_CONCURRENCY=1,
+    DOWNLOAD_CONCURRENCY_MAX=1,
+    DOWNLOAD_HEDGE_FACTOR=0,
+    DOWNLOAD_RANGE_SIZE=4,
+    HOST_RATE=0,
+    HOST_CONNECTIONS=0,
+)
+class DownloadRangesTestCase(OriginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.job = mock.Mock(pk=1)
+        self.files["media.mp4"] = b"0123456789abcdef"
+        self.target = os.path.join(self.media_root, "media.mp4")
+
+    def download(self):
+        download_ranges(self.job, self.url("media.mp4"), 16, {}, self.target)
+
+    def test_downloads_ranges(self):
+        self.download()
+
+        with open(self.target, "rb") as f:
+            self.assertEqual(f.read(), self.files["media.mp4"])
+        self.assertEqual(
+            [byterange for _, byterange in self.requests],
+            ["bytes=0-3", "bytes=4-7", "bytes=8-11", "bytes=12-15"],
+        )
+        self.assertFalse(os.path.exists(get_scratch_path(self.job)))
+
+    def test_resumes_missing_ranges(self):
+        self.failing.add("bytes=8-11")
+        with self.assertRaises(FailedToDownloadSegmentException):
+            self.download()
+        self.assertFalse(os.path.exists(self.target))
+
+        self.failing.clear()
+        self.requests = []
+        self.download()
+
+        with open(self.target, "rb") as f:
+            self.assertEqual(f.read(), self.files["media.mp4"])
+        self.assertEqual(
+            [byterange for _, byterange in self.requests], ["bytes=8-11", "bytes=12-15"]
+        )
+
+    def test_failed_job_keeps_ranges(self):
+        self.failing.add("bytes=8-11")
+        with self.assertRaises(FailedToDownloadSegmentException):
+            self.download()
+        self.job.status = Job.FAILED
+        remove_job_scratch(Job, self.job)
+
+        self.failing.clear()
+        self.requests = []
+        self.download()
+
+        self.assertEqual(
+            [byterange for _, byterange in self.requests], ["bytes=8-11", "bytes=12-15"]
+        )
+
+
+class IterProgressTestCase(SimpleTestCase):
+    def test_parses_blocks(self):
+        lines = [
+            b"frame=10\n",
+            b"bitrate=1234.5kbits/s\n",
+            b"out_time_us=2500000\n",
+            b"speed=1.5x\n",
+            b"progress=continue\n",
+            b"bitrate=N/A\n",
+            b"out_time_ms=5000000\n",
+            b"speed=N/A\n",
+            b"progress=end\n",
+        ]
+
+        self.assertEqual(
+            list(iter_progress(lines)),
+            [
+                {"time": 2.5, "speed": 1.5, "bitrate": 1234.5, "done": False},
+                {"time": 5.0, "speed": None, "bitrate": None, "done": True},
+            ],
+        )
+
+    def test_ignores_unknown_times(self):
+        lines = [b"out_time_us=N/A\n", b"progress=continue\n", b"progress=end\n"]
+
+        self.assertEqual(
+            [progress["time"] for progress in iter_progress(lines)], [None, None]
+        )
+
+
+class ConcatStreamTestCase(TemporaryMediaMixin, AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.target = os.path.join(self.media_root, "media.ts")
+
+    async def iter_chunks(self, *chunks):
+        for chunk in chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def test_writes_chunks_in_order(self):
+        size = self.run_async(
+            concat_stream(self.iter_chunks(b"ab", b"cd"), self.target)
+        )
+
+        self.assertEqual(size, 4)
+        with open(self.target, "rb") as f:
+            self.assertEqual(f.read(), b"abcd")
+        self.assertEqual(os.listdir(self.media_root), ["media.ts"])
+
+    def test_removes_output_on_failure(self):
+        chunks = self.iter_chunks(b"ab", ValueError("failed"))
+        with self.assertRaises(ValueError):
+            self.run_async(concat_stream(chunks, self.target))
+
+        self.assertEqual(os.listdir(self.media_root), [])
+
+    def test_closes_chunks_when_writing_fails(self):
+        closed = []
+
+        async def iter_chunks():
+            try:
+                while True:
+                    yield b"ab"
+            finally:
+                closed.append(True)
+
+        with mock.patch("rippy.muxer.open", mock.mock_open(), create=True) as m:
+            m.return_value.write.side_effect = OSError("No space left on device")
+            with self.assertRaises(OSError):
+                self.run_async(concat_stream(iter_chunks(), self.target))
+
+        self.assertEqual(closed, [True])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+@mock.patch("rippy.tasks.handle_job")
+class MediaTestCase(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = Job.objects.create(url="http://example.com/1", scheduled=True)
+        self.job = Job.objects.create(url="http://example.com/1", scheduled=True)
+
+    def claim(self, job):
+        return claim_media(
+            job, "stub", "1", get_variant_key("http://cdn.example.com/1.mp4", MP4)
+        )
+
+    def finish(self, job):
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, str(job.pk)))
+        job.name = "media.mp4"
+        job.path = os.path.join(str(job.pk), job.name)
+        with open(os.path.join(settings.MEDIA_ROOT, str(job.path)), "wb") as f:
+            f.write(b"media")
+        job.status = Job.SUCCESS
+        job.save()
+
+    def test_variant_key_ignores_query(self, handle_job):
+        self.assertEqual(
+            get_variant_key("http://cdn1.example.com/720p.m3u8?token=1", MP4),
+            get_variant_key("http://cdn1.example.com/720p.m3u8?token=2", MP4),
+        )
+        self.assertNotEqual(
+            get_variant_key("http://cdn1.example.com/720p.m3u8", MP4),
+            get_variant_key("http://cdn1.example.com/1080p.m3u8", MP4),
+        )
+
+    def test_duplicate_waits_for_owner(self, handle_job):
+        self.assertTrue(self.claim(self.owner))
+        self.assertFalse(self.claim(self.job))
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.DOWNLOADING)
+        self.assertEqual(self.job.duplicate_of, self.owner)
+
+        self.finish(self.owner)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.SUCCESS)
+        self.assertIsNone(self.job.duplicate_of)
+        self.assertTrue(
+            os.path.samefile(
+                os.path.join(settings.MEDIA_ROOT, str(self.owner.path)),
+                os.path.join(settings.MEDIA_ROOT, str(self.job.path)),
+            )
+        )
+        self.assertTrue(Media.objects.get(job=self.owner).complete)
+
+    def test_complete_media_is_reused(self, handle_job):
+        self.assertTrue(self.claim(self.owner))
+        self.finish(self.owner)
+
+        self.assertFalse(self.claim(self.job))
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.SUCCESS)
+        self.assertEqual(self.job.path, "%s/media.mp4" % (self.job.pk,))
+
+    def test_duplicates_restart_when_owner_fails(self, handle_job):
+        self.assertTrue(self.claim(self.owner))
+        self.assertFalse(self.claim(self.job))
+
+        self.owner.status = Job.FAILED
+        self.owner.save()
+        self.assertFalse(Media.objects.exists())
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.PENDING)
+        self.assertIsNone(self.job.duplicate_of)
+        handle_job.delay.assert_called_once_with(self.job.pk)
+
+        self.assertTrue(self.claim(self.job))
+        self.assertEqual(Media.objects.get().job, self.job)
+
+    def test_retried_owner_downloads_again(self, handle_job):
+        self.assertTrue(self.claim(self.owner))
+        self.finish(self.owner)
+
+        self.owner.status = Job.PENDING
+        self.owner.save()
+        self.assertTrue(self.claim(self.owner))
+        self.assertFalse(Media.objects.get().complete)
+        self.assertFalse(self.claim(self.job))
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.DOWNLOADING)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class JobListTestCase(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.jobs = [
+            Job.objects.create(
+                url="http://example.com/%s" % (i,),
+                status=Job.FAILED if i % 2 else Job.SUCCESS,
+                scheduled=True,
+            )
+            for i in range(5)
+        ]
+        now = timezone.now()
+        for i, job in enumerate(self.jobs):
+            Job.objects.filter(pk=job.pk).update(
+                last_updated=now - timedelta(minutes=len(self.jobs) - i)
+            )
+            job.refresh_from_db()
+
+    def get_ids(self, response):
+        return [job["id"] for job in response.json()["results"]]
+
+    def test_filter_status(self):
+        response = self.client.get("/api/jobs/", {"status": Job.FAILED})
+        self.assertEqual(
+            self.get_ids(response),
+            [job.pk for job in reversed(self.jobs) if job.status == Job.FAILED],
+        )
+
+        response = self.client.get("/api/jobs/", {"status": "failed,success"})
+        self.assertEqual(response.json()["count"], 5)
+
+    def test_filter_last_updated(self):
+        job = self.jobs[1]
+        response = self.client.get(
+            "/api/jobs/", {"last_updated__gt": job.last_updated.isoformat()}
+        )
+        self.assertEqual(
+            self.get_ids(response), [job.pk for job in reversed(self.jobs[2:])]
+        )
+
+        response = self.client.get("/api/jobs/", {"last_updated__gt": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor(self):
+        response = self.client.get("/api/jobs/", {"cursor": "", "limit": 2})
+        ids = self.get_ids(response)
+        while response.json()["next"]:
+            response = self.client.get(response.json()["next"])
+            ids += self.get_ids(response)
+
+        self.assertEqual(ids, [job.pk for job in reversed(self.jobs)])
+
+    def test_not_modified(self):
+        response = self.client.get("/api/jobs/")
+        etag = response["ETag"]
+        response = self.client.get("/api/jobs/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.jobs[0].hidden = True
+        self.jobs[0].save()
+        response = self.client.get("/api/jobs/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch("rippy.views.group")
+    def test_bulk(self, group):
+        response = self.client.post(
+            "/api/jobs/bulk/",
+            [{"url": "http://example.com/a"}, {"url": "http://example.com/b"}],
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        ids = [job["id"] for job in response.json()]
+        self.assertEqual(Job.objects.filter(pk__in=ids, scheduled=True).count(), 2)
+        group.return_value.delay.assert_called_once_with()
+
+        response = self.client.post(
+            "/api/jobs/bulk/", [{"url": "not an url"}], format="json"
+        )
+        self.assertEqual(response.status_code, 400)
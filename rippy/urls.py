@@ -1,10 +1,10 @@
 from django.urls import path
 from rest_framework import routers
 
-from .views import JobViewSet, ConfigView
+from .views import JobViewSet, ConfigView, metrics
 
 
-urlpatterns = [path("config/", ConfigView.as_view())]
+urlpatterns = [path("config/", ConfigView.as_view()), path("metrics/", metrics)]
 
 router = routers.SimpleRouter()
 router.register(r"jobs", JobViewSet)
@@ -1,13 +1,44 @@
+import hashlib
+
+from celery import group
 from django.conf import settings
 
-from rest_framework import serializers, viewsets, views
+from django.db import connection, transaction
+from django.db.models import Avg, Count, Max, Q, Sum
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from prometheus_client import CONTENT_TYPE_LATEST
+from rest_framework import pagination, serializers, status, viewsets, views
+from rest_framework.exceptions import ValidationError
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from .models import Job
+from .events import get_event_publisher
+from .metrics import generate_metrics
+from .models import Job, JobSpan
+from .tasks import handle_job
+
+
+class JobSpanSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = JobSpan
+        fields = (
+            "name",
+            "started",
+            "ended",
+            "duration",
+            "failed",
+            "bytes",
+            "segments",
+            "retries",
+        )
 
 
 class JobSerializer(serializers.ModelSerializer):
+    timeline = JobSpanSerializer(source="spans", many=True, read_only=True)
+
     class Meta:
         model = Job
         fields = (
@@ -18,14 +49,181 @@ class JobSerializer(serializers.ModelSerializer):
             "path",
             "name",
             "hidden",
+            "variant_policy",
+            "max_bandwidth",
+            "max_height",
+            "output_format",
+            "extractor",
+            "timeline",
             "last_updated",
             "created",
         )
 
 
+class JobEventSerializer(JobSerializer):
+    """Jobs in job.update events, sent on every save so without the timeline"""
+
+    class Meta(JobSerializer.Meta):
+        fields = tuple(
+            field for field in JobSerializer.Meta.fields if field != "timeline"
+        )
+
+
+class JobCursorPagination(pagination.CursorPagination):
+    ordering = "-id"
+    page_size_query_param = "limit"
+    max_page_size = 1000
+
+
+class JobPagination(pagination.LimitOffsetPagination):
+    """
+    Limit and offset pagination, or keyset pagination on id when the request
+    has a cursor parameter. Start with an empty ?cursor= and follow next, it
+    does not count or skip rows so it stays fast on large tables.
+    """
+
+    cursor_query_param = "cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_pagination = None
+        if self.cursor_query_param in request.query_params:
+            self.cursor_pagination = JobCursorPagination()
+            return self.cursor_pagination.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_pagination:
+            return self.cursor_pagination.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
 class JobViewSet(viewsets.ModelViewSet):
-    queryset = Job.objects.filter(hidden=False)
+    queryset = Job.objects.filter(hidden=False).prefetch_related("spans")
     serializer_class = JobSerializer
+    pagination_class = JobPagination
+    max_bulk_jobs = 1000
+
+    def get_queryset(self):
+        """
+        The list can be filtered with ?status=, comma separated for several,
+        and ?last_updated__gt= to only get jobs changed since an ISO 8601 time.
+        """
+        queryset = super().get_queryset()
+        if self.action != "list":
+            return queryset
+
+        status = self.request.query_params.get("status")
+        if status:
+            queryset = queryset.filter(status__in=status.split(","))
+
+        last_updated = self.request.query_params.get("last_updated__gt")
+        if last_updated:
+            # A + in the offset is decoded as a space when it is not escaped
+            try:
+                last_updated = parse_datetime(last_updated.replace(" ", "+"))
+            except ValueError:
+                last_updated = None
+            if last_updated is None:
+                raise ValidationError({"last_updated__gt": "Invalid datetime"})
+            queryset = queryset.filter(last_updated__gt=last_updated)
+
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        """
+        Jobs with an ETag and Last-Modified that change when any job is saved
+        or a visible job is deleted, a conditional request for an unchanged
+        list gets a 304. They are found with lookups on the job indexes
+        instead of aggregating the filtered jobs on every poll.
+        """
+        updated = [
+            Job.objects.filter(hidden=hidden).aggregate(
+                last_updated=Max("last_updated")
+            )["last_updated"]
+            for hidden in (False, True)
+        ]
+        count = Job.objects.filter(hidden=False).count()
+        etag = quote_etag(
+            hashlib.md5(
+                (
+                    "%s:%s:%s:%s"
+                    % (request.get_full_path(), count, updated[0], updated[1])
+                ).encode("utf-8")
+            ).hexdigest()
+        )
+        last_modified = None
+        if any(updated):
+            last_modified = int(max(u for u in updated if u).timestamp())
+
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if not_modified is not None:
+            return not_modified
+
+        response = super().list(request, *args, **kwargs)
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+        return response
+
+    @action(detail=False)
+    def timings(self, request):
+        """Time spent in each step of jobs, per extractor"""
+        spans = (
+            JobSpan.objects.values("job__extractor", "name")
+            .annotate(
+                count=Count("id"),
+                failed=Count("id", filter=Q(failed=True)),
+                average=Avg("duration"),
+                longest=Max("duration"),
+                bytes=Sum("bytes"),
+                retries=Sum("retries"),
+            )
+            .order_by("job__extractor", "name")
+        )
+
+        summary = {}
+        for span in spans:
+            extractor = span.pop("job__extractor") or "unknown"
+            summary.setdefault(extractor, {})[span.pop("name")] = span
+        return Response(summary)
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        Create a list of jobs in one transaction and schedule them together,
+        clients get a single job.add event with all of them before the jobs
+        are scheduled.
+        """
+        if not isinstance(request.data, list) or not request.data:
+            raise ValidationError("Expected a list of jobs")
+        if len(request.data) > self.max_bulk_jobs:
+            raise ValidationError(
+                "At most %s jobs can be added at once" % (self.max_bulk_jobs,)
+            )
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        jobs = [Job(scheduled=True, **item) for item in serializer.validated_data]
+        for job in jobs:
+            job.bulk_added = True
+
+        with transaction.atomic():
+            if connection.features.can_return_ids_from_bulk_insert:
+                Job.objects.bulk_create(jobs)
+            else:
+                # Without ids from the insert the jobs are saved one by one,
+                # bulk_added keeps post_save from sending an event for each
+                for job in jobs:
+                    job.save()
+
+        job_ids = [job.pk for job in jobs]
+        jobs = Job.objects.filter(pk__in=job_ids).order_by("id")
+        data = self.get_serializer(jobs.prefetch_related("spans"), many=True).data
+        get_event_publisher().publish(None, "job.add", merge=False, jobs=data)
+        group(handle_job.s(job_id) for job_id in job_ids).delay()
+        return Response(data, status=status.HTTP_201_CREATED)
 
     @action(detail=True, methods=["post"])
     def cancel(self, request, pk=None):
@@ -58,3 +256,8 @@ class ConfigView(views.APIView):
             config["parse_browser_url"] = settings.PARSE_BROWSER_URL
 
         return Response(config)
+
+
+def metrics(request):
+    """Prometheus metrics of this process and all processes sharing RIPPY_METRICS_DIR"""
+    return HttpResponse(generate_metrics(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+
+from django.db import close_old_connections
+from pyppeteer import errors
+
+from .browser import BrowserUnavailableException, get_browser_pool
+from .extractors import EXTRACTORS
+from .extractors._base import ExtractionCancelledException, JobFailedException
+from .models import Job
+from .tasks import handle_job
+
+logger = logging.getLogger(__name__)
+
+
+class SuspendedJobWatcher:
+    """
+    Watches the pages of jobs that were suspended while waiting for user-input
+    and hands the job back to a worker when the extraction can continue.
+    """
+
+    poll_interval = 2
+
+    def __init__(self):
+        self.browser_pool = get_browser_pool()
+        self.watching = {}
+
+    async def run(self):
+        while True:
+            close_old_connections()
+            try:
+                await self.update()
+            except (BrowserUnavailableException, errors.PyppeteerError):
+                logger.exception("Failed to check suspended jobs")
+            await asyncio.sleep(self.poll_interval)
+
+    async def update(self):
+        jobs = {
+            job.pk: job
+            for job in Job.objects.filter(status=Job.WAITING).exclude(
+                suspended_state=""
+            )
+        }
+
+        for job_id, future in list(self.watching.items()):
+            if job_id not in jobs:
+                logger.info("Job %s is no longer suspended, stop watching" % (job_id,))
+                future.cancel()
+                del self.watching[job_id]
+
+        for job_id, job in jobs.items():
+            if job_id in self.watching:
+                continue
+            logger.info("Watching suspended job %s" % (job_id,))
+            future = asyncio.ensure_future(self.watch(job))
+            future.add_done_callback(lambda f, job_id=job_id: self.unwatch(job_id, f))
+            self.watching[job_id] = future
+
+    def unwatch(self, job_id, future):
+        if self.watching.get(job_id) is future:
+            del self.watching[job_id]
+
+    def restart_job(self, job, reason):
+        job.refresh_from_db()
+        if job.status != job.WAITING:
+            return
+
+        logger.info("Restarting job %s: %s" % (job.pk, reason))
+        job.suspended_state = ""
+        job.status = job.PENDING
+        job.status_message = reason
+        job.scheduled = False
+        job.save()
+
+    async def watch(self, job):
+        suspended = json.loads(job.suspended_state)
+        page = await self.browser_pool.find_page(suspended["target_id"])
+        if page is None:
+            self.restart_job(job, "Browser page was closed, restarting job")
+            return
+
+        extractor_cls = {e.name: e for e in EXTRACTORS}[suspended["extractor"]]
+        extractor = extractor_cls(job, page)
+        browser = self.browser_pool.browser
+        browser.on("disconnected", extractor.cancel)
+        page.on("close", extractor.cancel)
+
+        try:
+            result = await extractor.resume(suspended["state"])
+        except asyncio.CancelledError:
+            await self.browser_pool.close_page(page)
+            raise
+        except JobFailedException as e:
+            job.suspended_state = ""
+            job.status = job.FAILED
+            job.status_message = str(e)
+            job.save()
+            await self.browser_pool.close_page(page)
+            return
+        except (ExtractionCancelledException, errors.PyppeteerError):
+            if self.browser_pool.browser is not None:
+                self.restart_job(job, "Browser page was closed, restarting job")
+            return
+        finally:
+            browser.remove_listener("disconnected", extractor.cancel)
+
+        await self.browser_pool.close_page(page)
+
+        job.refresh_from_db()
+        if job.status != job.WAITING:
+            return
+
+        logger.info("Suspended job %s can continue" % (job.pk,))
+        job.suspended_state = ""
+        job.status = job.PENDING
+        job.status_message = "Continuing job"
+        job.save()
+        handle_job.delay(job.pk, result)
@@ -1,5 +1,14 @@
+if [ -n "$RIPPY_METRICS_DIR" ]; then
+    rm -rf "$RIPPY_METRICS_DIR"
+    mkdir -p "$RIPPY_METRICS_DIR"
+fi
+
 python manage.py migrate
 python manage.py collectstatic --noinput -c
-python manage.py cleanup_active
+python manage.py cleanup_active --retry
+
+export RIPPY_EXTRACT_WORKERS=${RIPPY_EXTRACT_WORKERS:-$RIPPY_CONCURRENCY}
+export RIPPY_DOWNLOAD_WORKERS=${RIPPY_DOWNLOAD_WORKERS:-$RIPPY_CONCURRENCY}
+export RIPPY_MUX_WORKERS=${RIPPY_MUX_WORKERS:-$RIPPY_CONCURRENCY}
 
 exec supervisord -n -c /supervisor.conf
\ No newline at end of file